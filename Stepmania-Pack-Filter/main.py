@@ -1,28 +1,137 @@
 import os
+import sys
+import argparse
+import json
+import mmap
+import time
+import zipfile
+import sqlite3
+import re
+import hashlib
+import cProfile
+import pstats
+from contextlib import contextmanager
+from collections import deque
+from array import array
+from functools import partial
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 SONGS_FOLDER = 'D:\\Other\\Mega\\MEGAsync\\Dance-Games\\ITGMania\\Songs'
 MIN_DIFF = 7
 MAX_DIFF = 10
 RIGHT_SONG_PERCENTAGE = 0.25
 MAX_MISTAKE_PERCENTAGE = 0.1
+WORKER_COUNT = os.cpu_count() or 1 # 1 scans serially
+SPLIT_BY = "pack" # pack song
+SONG_CHUNK_SIZE = 32 # Songs per task when SPLIT_BY is song
+WATCH_INTERVAL = 10 # Seconds between polls in watch mode
+USE_INDEX = True # True False
+INDEX_FILE = 'index.sqlite'
+INDEX_VERSION = 5
+WRITE_COLUMNS = True # True False
+COLUMNS_FILE = 'charts.npz'
+CHECKPOINT_FILE = 'scan.checkpoint'
+FIND_DUPLICATES = True # True False
+SKIP_DUPLICATES = False # True False, leaves songs whose charts all appeared earlier out of the pack counts
+USE_BYTE_SCANNER = True # True False
+ENCODINGS = ['utf-8', 'latin-1', 'cp1252', 'iso-8859-1']
+# (min, max) per metric, None for no bound. Needs USE_BYTE_SCANNER, metrics are also computed for WRITE_COLUMNS
+DENSITY_LIMITS = {} # {"peak_nps": (None, 8), "stream": (0.25, None)}
+METRICS = ["peak_nps", "stream", "jumps", "holds"]
+STREAM_MEASURE_ROWS = 16
+TAP_NOTES = b'124L'
+HOLD_NOTES = b'24'
+REPORT_FILE = 'scan-report.json'
+STAGES = ["discovery", "decode", "parse"]
+PROFILE_PARSERS = False # True False, writes a cProfile of the chart parsers to PROFILE_FILE
+PROFILE_FOLDER = 'profiles'
+PROFILE_FILE = 'parsers.prof'
 
-def read_file_with_encodings(filepath, encodings=['utf-8', 'latin-1', 'cp1252', 'iso-8859-1']):
-    for encoding in encodings:
-        try:
-            with open(filepath, 'r', encoding=encoding) as file:
-                return file.readlines()
-        except UnicodeDecodeError:
-            print(f"Failed to decode {filepath} with {encoding}. Trying next encoding.")
-    print(f"Error parsing {filepath}: Unable to decode with any of the provided encodings.")
-    return None
+stats = None
+stage_timers = []
+profiler = None
 
-def parse_sm_file(filepath, pack_name, song_name):
-    charts = []
-    dance_single_difficulties = []
+def new_stats():
+    return {stage: {"seconds": 0.0, "folders_scanned": 0, "files_opened": 0, "bytes_read": 0, "encoding_attempts": 0, "parse_failures": 0} for stage in STAGES}
+
+def add_stats(total, other):
+    for stage, counters in other.items():
+        for counter, value in counters.items():
+            total[stage][counter] += value
+
+    return total
+
+@contextmanager
+def measure(stage):
+    # Stage times are exclusive, a nested stage pauses the one around it
+    now = time.perf_counter()
+    if stage_timers:
+        outer_stage, start = stage_timers[-1]
+        stats[outer_stage]["seconds"] += now - start
+    stage_timers.append([stage, now])
+
+    try:
+        yield stats[stage]
+    finally:
+        now = time.perf_counter()
+        _, start = stage_timers.pop()
+        stats[stage]["seconds"] += now - start
+        if stage_timers:
+            stage_timers[-1][1] = now
+
+def collect_stats(function, *args):
+    # Runs one scan task and returns its result together with the stats it gathered
+    global stats
+    stats = new_stats()
+    result = function(*args)
+
+    if profiler:
+        os.makedirs(PROFILE_FOLDER, exist_ok=True)
+        profiler.dump_stats(os.path.join(PROFILE_FOLDER, f"{os.getpid()}.prof"))
+
+    return result, stats
+
+def profile_parser(function, *args):
+    global profiler
+    if not PROFILE_PARSERS:
+        return function(*args)
+
+    if profiler is None:
+        profiler = cProfile.Profile()
+
+    profiler.enable()
+    try:
+        return function(*args)
+    finally:
+        profiler.disable()
+
+stats = new_stats()
+
+def read_file_with_encodings(filepath, encodings=ENCODINGS):
+    with measure("decode") as stage_stats:
+        for encoding in encodings:
+            stage_stats["files_opened"] += 1
+            stage_stats["encoding_attempts"] += 1
+            stage_stats["bytes_read"] += os.path.getsize(filepath)
+            try:
+                with open(filepath, 'r', encoding=encoding) as file:
+                    return file.readlines()
+            except UnicodeDecodeError:
+                print(f"Failed to decode {filepath} with {encoding}. Trying next encoding.")
+        print(f"Error parsing {filepath}: Unable to decode with any of the provided encodings.")
+        stage_stats["parse_failures"] += 1
+        return None
+
+def parse_sm_file(filepath):
+    with measure("parse"):
+        return parse_sm_lines(read_file_with_encodings(filepath))
+
+def parse_sm_lines(lines):
+    steps = []
 
-    lines = read_file_with_encodings(filepath)
     if lines is None:
-        return charts, dance_single_difficulties
+        return steps
 
     i = 0
     while i < len(lines):
@@ -50,10 +159,7 @@ def parse_sm_file(filepath, pack_name, song_name):
                 except ValueError:
                     meter = None
 
-                if stepstype == 'dance-single' and meter is not None:
-                    dance_single_difficulties.append((pack_name, song_name, meter))
-                    if MIN_DIFF <= meter <= MAX_DIFF:
-                        charts.append((pack_name, song_name, meter))
+                steps.append((stepstype, meter, None, None))
 
             while i < len(lines) and not lines[i].strip() == ';':
                 i += 1
@@ -62,15 +168,17 @@ def parse_sm_file(filepath, pack_name, song_name):
         else:
             i += 1
 
-    return charts, dance_single_difficulties
+    return steps
 
-def parse_ssc_file(filepath, pack_name, song_name):
-    charts = []
-    dance_single_difficulties = []
+def parse_ssc_file(filepath):
+    with measure("parse"):
+        return parse_ssc_lines(read_file_with_encodings(filepath))
+
+def parse_ssc_lines(lines):
+    steps = []
 
-    lines = read_file_with_encodings(filepath)
     if lines is None:
-        return charts, dance_single_difficulties
+        return steps
 
     i = 0
     while i < len(lines):
@@ -103,81 +211,928 @@ def parse_ssc_file(filepath, pack_name, song_name):
                 else:
                     i += 1
 
-            if stepstype == 'dance-single' and meter is not None:
-                dance_single_difficulties.append((pack_name, song_name, meter))
-                if MIN_DIFF <= meter <= MAX_DIFF:
-                    charts.append((pack_name, song_name, meter))
+            steps.append((stepstype, meter, None, None))
         else:
             i += 1
 
-    return charts, dance_single_difficulties
+    return steps
+
+def iter_tags(data):
+    # Yields (tag, value_start, value_end) for every #TAG:value; without copying the values
+    pos = 0
+    while True:
+        pos = data.find(b'#', pos)
+        if pos == -1:
+            return
+
+        line_start = data.rfind(b'\n', 0, pos) + 1
+        if data.find(b'//', line_start, pos) != -1:
+            pos = data.find(b'\n', pos)
+            if pos == -1:
+                return
+            continue
 
-def process_song(song_folder, pack_name):
-    ssc_file = None
-    sm_file = None
+        colon = data.find(b':', pos, pos + 64)
+        if colon == -1:
+            pos += 1
+            continue
 
-    for root, _, files in os.walk(song_folder):
-        for file in files:
-            if file.endswith('.ssc'):
-                ssc_file = os.path.join(root, file)
-            elif file.endswith('.sm'):
-                sm_file = os.path.join(root, file)
+        # Like StepMania, a value missing its ';' ends where a line starts with the next tag
+        end = data.find(b';', colon)
+        if end == -1:
+            end = len(data)
+        next_tag = data.find(b'\n#', colon, end)
+        if next_tag != -1:
+            end = next_tag
 
-    if ssc_file:
-        return parse_ssc_file(ssc_file, pack_name, os.path.basename(song_folder))
-    elif sm_file:
-        return parse_sm_file(sm_file, pack_name, os.path.basename(song_folder))
+        yield data[pos + 1:colon], colon + 1, end
+        pos = end + 1
 
-    return [], []
+def strip_comments(value):
+    return b'\n'.join(line.split(b'//')[0] for line in value.split(b'\n'))
 
-def main():
-    debug_lines = []
-    result_lines = []
-    potential_mistakes = []
+def decode_fields(fields):
+    with measure("decode") as stage_stats:
+        raw = b'\0'.join(fields)
+        for encoding in ENCODINGS:
+            stage_stats["encoding_attempts"] += 1
+            try:
+                return raw.decode(encoding).split('\0')
+            except UnicodeDecodeError:
+                pass
 
-    for pack in os.listdir(SONGS_FOLDER):
-        pack_folder = os.path.join(SONGS_FOLDER, pack)
-        if not os.path.isdir(pack_folder):
+        return raw.decode('latin-1').split('\0')
+
+def scan_sm_bytes(data):
+    song_bpms = b''
+    charts = []
+    for tag, start, end in iter_tags(data):
+        if tag == b'BPMS':
+            song_bpms = data[start:end]
+            continue
+        elif tag != b'NOTES':
+            continue
+
+        # Only the five header fields are read, the note data up to ';' is skipped
+        header_end = start
+        for _ in range(5):
+            header_end = data.find(b':', header_end, end)
+            if header_end == -1:
+                break
+            header_end += 1
+
+        if header_end == -1:
+            continue
+
+        header = strip_comments(data[start:header_end]).split(b':')
+        charts.append([header[0], header[3], None, header_end, end])
+
+    return charts, song_bpms
+
+def scan_ssc_bytes(data):
+    song_bpms = b''
+    charts = []
+    chart = None
+    for tag, start, end in iter_tags(data):
+        if tag == b'NOTEDATA':
+            chart = [b'', b'', None, end, end]
+        elif tag == b'BPMS' and chart is None:
+            song_bpms = data[start:end]
+        elif chart is None:
+            continue
+        elif tag == b'STEPSTYPE':
+            chart[0] = data[start:end]
+        elif tag == b'METER':
+            chart[1] = data[start:end]
+        elif tag == b'BPMS':
+            chart[2] = data[start:end]
+        elif tag == b'NOTES':
+            chart[3], chart[4] = start, end
+            charts.append(chart)
+            chart = None
+
+    if chart is not None:
+        charts.append(chart)
+
+    return charts, song_bpms
+
+# Charts without notes still get a hash so their cached entries stay valid, they are never counted as duplicates
+EMPTY_NOTES_HASH = hashlib.blake2b(b'', digest_size=16).hexdigest()
+
+def hash_notes(notes):
+    if b'//' in notes:
+        notes = re.sub(rb'//[^\n]*', b'', notes)
+    notes = notes.translate(None, b' \t\r\n')
+
+    return hashlib.blake2b(notes, digest_size=16).hexdigest()
+
+def parse_bpms(bpms):
+    beats = []
+    values = []
+    for change in bpms.decode('latin-1').split(','):
+        beat, _, value = change.partition('=')
+        try:
+            beat, value = float(beat), float(value)
+        except ValueError:
             continue
+        if value > 0:
+            beats.append(beat)
+            values.append(value)
+
+    return np.array(beats or [0.0]), np.array(values or [120.0])
+
+def analyze_notes(notes, bpms):
+    # Metrics for a 4-panel note body, computed on the whole body at once. #STOPS are ignored.
+    if b'//' in notes:
+        notes = re.sub(rb'//[^\n]*', b'', notes)
+    chars = np.frombuffer(notes.translate(None, b' \t\r\n'), dtype=np.uint8)
+
+    is_comma = chars == ord(',')
+    char_measures = np.cumsum(is_comma)[~is_comma]
+    chars = chars[~is_comma]
+    measure_lengths = np.bincount(char_measures)
+    if len(chars) == 0 or np.any(measure_lengths % 4):
+        return {}
+
+    rows = chars.reshape(-1, 4)
+    row_measures = char_measures[::4]
+    rows_per_measure = measure_lengths // 4
+
+    notes_per_row = np.isin(rows, np.frombuffer(TAP_NOTES, dtype=np.uint8)).sum(axis=1)
+    step_rows = notes_per_row > 0
+    if not step_rows.any():
+        return {"peak_nps": 0.0, "stream": 0.0, "jumps": 0, "holds": 0}
+
+    steps_per_measure = np.bincount(row_measures[step_rows], minlength=len(rows_per_measure))
+    first, last = row_measures[step_rows][[0, -1]]
+    played_measures = steps_per_measure[first:last + 1]
+
+    # Peak density is the busiest measure's step rows over its length in seconds, so a steady
+    # stream comes out at exactly its rate instead of depending on where a one second window falls
+    bpm_beats, bpm_values = bpms
+    order = np.argsort(bpm_beats, kind='stable')
+    bpm_beats, bpm_values = bpm_beats[order], bpm_values[order]
+    measure_beats = 4.0 * np.arange(len(rows_per_measure) + 1)
+    segment_times = np.concatenate(([0.0], np.cumsum(np.diff(bpm_beats) * 60 / bpm_values[:-1])))
+    segments = np.clip(np.searchsorted(bpm_beats, measure_beats, side='right') - 1, 0, None)
+    measure_times = segment_times[segments] + (measure_beats - bpm_beats[segments]) * 60 / bpm_values[segments]
+    measure_seconds = np.diff(measure_times)
+    timed_measures = measure_seconds > 0
+    peak_nps = (steps_per_measure[timed_measures] / measure_seconds[timed_measures]).max(initial=0.0)
+
+    return {
+        "peak_nps": round(float(peak_nps), 6),
+        "stream": float(np.mean(played_measures >= STREAM_MEASURE_ROWS)),
+        "jumps": int(np.count_nonzero(notes_per_row >= 2)),
+        "holds": int(np.isin(rows, np.frombuffer(HOLD_NOTES, dtype=np.uint8)).sum()),
+    }
+
+def is_computing_metrics():
+    # Only the byte scanner reads note data
+    return USE_BYTE_SCANNER and bool(DENSITY_LIMITS or WRITE_COLUMNS)
+
+def is_finding_duplicates():
+    return FIND_DUPLICATES and USE_BYTE_SCANNER
+
+def check_settings():
+    if DENSITY_LIMITS and not USE_BYTE_SCANNER:
+        sys.exit("DENSITY_LIMITS needs USE_BYTE_SCANNER, the legacy parsers don't read note data")
+    if FIND_DUPLICATES and not USE_BYTE_SCANNER:
+        print("FIND_DUPLICATES needs USE_BYTE_SCANNER, the legacy parsers don't read note data. Not looking for duplicates")
+
+def scan_chart_data(data, is_ssc):
+    if is_ssc:
+        charts, song_bpms = scan_ssc_bytes(data)
+    else:
+        charts, song_bpms = scan_sm_bytes(data)
+
+    fields = decode_fields([field for chart in charts for field in chart[:2]]) if charts else []
+    if not charts:
+        stats["parse"]["parse_failures"] += 1
+
+    steps = []
+    for i, (_, _, bpms, notes_start, notes_end) in enumerate(charts):
+        stepstype = fields[i * 2].strip() or None
+        try:
+            meter = int(fields[i * 2 + 1].strip())
+        except ValueError:
+            meter = None
+            stats["parse"]["parse_failures"] += 1
+
+        metrics = None
+        notes_hash = None
+        if stepstype == 'dance-single':
+            if is_computing_metrics():
+                metrics = analyze_notes(data[notes_start:notes_end], parse_bpms(bpms if bpms is not None else song_bpms))
+                if not metrics:
+                    stats["parse"]["parse_failures"] += 1
+            if FIND_DUPLICATES:
+                notes_hash = hash_notes(data[notes_start:notes_end])
+
+        steps.append((stepstype, meter, metrics, notes_hash))
+
+    return steps
+
+def scan_chart_file(filepath):
+    with measure("decode") as stage_stats, open(filepath, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        stage_stats["files_opened"] += 1
+        stage_stats["bytes_read"] += size
+        if size == 0:
+            stats["parse"]["parse_failures"] += 1
+            return []
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data, measure("parse"):
+            return scan_chart_data(data, filepath.endswith('.ssc'))
+
+def is_chart_name(name):
+    # Hidden files and macOS ._ AppleDouble files next to a chart aren't charts
+    return name.endswith(('.ssc', '.sm')) and not name.startswith('.')
+
+def pick_chart_file(chart_files):
+    ssc_files = [chart_file for chart_file in chart_files if chart_file.endswith('.ssc')]
+    return min(ssc_files or chart_files)
+
+def find_chart_file(song_folder):
+    with measure("discovery") as stage_stats:
+        return find_chart_entry(song_folder, stage_stats)
+
+def find_chart_entry(song_folder, stage_stats):
+    # Breadth-first so audio, video and background subfolders are only entered when the song folder has no chart
+    folders = [song_folder]
+    while folders:
+        chart_entries = {}
+        subfolders = []
+        for folder in folders:
+            stage_stats["folders_scanned"] += 1
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        subfolders.append(entry.path)
+                    elif is_chart_name(entry.name):
+                        chart_entries[entry.path] = entry
+
+        if chart_entries:
+            return chart_entries[pick_chart_file(list(chart_entries))]
+
+        folders = sorted(subfolders)
+
+    return None
+
+def process_song(song_folder, cached_entry=None):
+    chart_entry = find_chart_file(song_folder)
+    entry = {
+        "song": os.path.basename(song_folder),
+        "chart_file": chart_entry.path if chart_entry else None,
+        "size": None,
+        "mtime": None,
+        "steps": [],
+    }
+
+    if chart_entry:
+        stat = chart_entry.stat()
+        entry["size"] = stat.st_size
+        entry["mtime"] = stat.st_mtime_ns
+
+        if is_cached_entry_valid(cached_entry, entry):
+            return cached_entry
+
+        try:
+            if USE_BYTE_SCANNER:
+                entry["steps"] = profile_parser(scan_chart_file, entry["chart_file"])
+            elif entry["chart_file"].endswith('.ssc'):
+                entry["steps"] = profile_parser(parse_ssc_file, entry["chart_file"])
+            else:
+                entry["steps"] = profile_parser(parse_sm_file, entry["chart_file"])
+        except OSError as e:
+            print(f"Error parsing {entry['chart_file']}: {str(e)}")
+            stats["parse"]["parse_failures"] += 1
+
+    return entry
+
+def is_cached_entry_valid(cached_entry, entry):
+    if not cached_entry or any(cached_entry[key] != entry[key] for key in ("chart_file", "size", "mtime")):
+        return False
+
+    charts = get_dance_single_charts(cached_entry)
+    if is_computing_metrics() and any(metrics is None for _, metrics, _ in charts):
+        return False
+
+    return not is_finding_duplicates() or all(notes_hash is not None for _, _, notes_hash in charts)
+
+def get_zip_songs(names):
+    # Maps every song folder in the archive to its chart members, like get_song_folders does for a pack folder
+    names = [
+        name for name in names
+        if not name.startswith('__MACOSX/') and not name.rstrip('/').split('/')[-1].startswith('._')
+    ]
+    files = [name for name in names if not name.endswith('/')]
+    chart_files = [name for name in files if is_chart_name(name.split('/')[-1])]
+
+    # The pack root is whatever the folders holding charts have in common, minus the song folder itself,
+    # so top level files like a readme don't hide it. It's at most the one folder a pack is zipped in,
+    # so a single song with its chart in a subfolder is still named after the song folder
+    chart_folders = [name.split('/')[:-1] for name in chart_files or files]
+    chart_folders = [folder for folder in chart_folders if folder]
+    root_parts = []
+    if chart_folders:
+        for parts in zip(*chart_folders):
+            if len(set(parts)) > 1:
+                break
+            root_parts.append(parts[0])
+        root_parts = root_parts[:min(len(folder) for folder in chart_folders) - 1][:1]
+    root = ''.join(f"{part}/" for part in root_parts)
+    chart_files = set(chart_files)
+
+    songs = {}
+    for name in names:
+        parts = name[len(root):].split('/') if name.startswith(root) else []
+        if len(parts) < 2:
+            continue
+
+        chart_members = songs.setdefault(parts[0], [])
+        if name in chart_files:
+            chart_members.append(name)
+
+    return songs
+
+def find_zip_chart_member(chart_members):
+    # Same choice as find_chart_file: the shallowest charts first, then .ssc over .sm, then by name
+    if not chart_members:
+        return None
+
+    depth = min(member.count('/') for member in chart_members)
+    return pick_chart_file([member for member in chart_members if member.count('/') == depth])
+
+def process_zip_pack(zip_path, cached_entries):
+    # Only chart members are decompressed, audio and graphics stay in the archive
+    entries = []
+    try:
+        archive = zipfile.ZipFile(zip_path)
+    except (zipfile.BadZipFile, OSError) as e:
+        print(f"Error opening {zip_path}: {str(e)}")
+        stats["parse"]["parse_failures"] += 1
+        return entries
+
+    with archive:
+        with measure("discovery") as stage_stats:
+            stage_stats["files_opened"] += 1
+            songs = get_zip_songs(archive.namelist())
+
+        for song, chart_members in songs.items():
+            entry = {"song": song, "chart_file": None, "size": None, "mtime": None, "steps": []}
+            with measure("discovery"):
+                member = find_zip_chart_member(chart_members)
+
+            if member:
+                info = archive.getinfo(member)
+                entry["chart_file"] = os.path.join(zip_path, member)
+                entry["size"] = info.file_size
+                entry["mtime"] = int(time.mktime(info.date_time + (0, 0, -1))) * 10**9
+
+                cached_entry = cached_entries.get(song)
+                if is_cached_entry_valid(cached_entry, entry):
+                    entry = cached_entry
+                else:
+                    try:
+                        with measure("decode") as stage_stats:
+                            stage_stats["files_opened"] += 1
+                            stage_stats["bytes_read"] += info.compress_size
+                            data = archive.read(member)
+                        with measure("parse"):
+                            entry["steps"] = profile_parser(scan_chart_data, data, member.endswith('.ssc'))
+                    except (zipfile.BadZipFile, NotImplementedError, OSError) as e:
+                        print(f"Error parsing {entry['chart_file']}: {str(e)}")
+                        stats["parse"]["parse_failures"] += 1
+
+            entries.append(entry)
+
+    return entries
+
+def get_dance_single_charts(entry):
+    return [(meter, metrics, notes_hash) for stepstype, meter, metrics, notes_hash in entry["steps"] if stepstype == 'dance-single' and meter is not None]
+
+def add_to_notes_index(notes_index, pack, entry):
+    # Returns whether every chart of the song already appeared in an earlier song, and a line per repeated chart
+    notes_hashes = [
+        (meter, notes_hash) for meter, _, notes_hash in get_dance_single_charts(entry)
+        if notes_hash and notes_hash != EMPTY_NOTES_HASH
+    ]
+    is_duplicate = bool(notes_hashes) and all(notes_hash in notes_index for _, notes_hash in notes_hashes)
+
+    duplicate_lines = []
+    for meter, notes_hash in notes_hashes:
+        first_pack, first_song, first_meter = notes_index.setdefault(notes_hash, (pack, entry["song"], meter))
+        if (first_pack, first_song) != (pack, entry["song"]):
+            duplicate_lines.append(f"{pack}/{entry['song']}: {meter} = {first_pack}/{first_song}: {first_meter}")
+
+    return is_duplicate, duplicate_lines
+
+def is_valid_chart(meter, metrics):
+    if not MIN_DIFF <= meter <= MAX_DIFF:
+        return False
+
+    for metric, (low, high) in DENSITY_LIMITS.items():
+        if not metrics or metric not in metrics:
+            return False
+        if (low is not None and metrics[metric] < low) or (high is not None and metrics[metric] > high):
+            return False
+
+    return True
+
+def is_selected_pack(song_count, parsed_song_count, valid_chart_count, right_song_percentage, max_mistake_percentage):
+    if song_count == 0 or valid_chart_count / song_count >= right_song_percentage:
+        return False
+
+    mistake_percentage = (song_count - parsed_song_count) / song_count
+    return mistake_percentage <= max_mistake_percentage
+
+def format_metrics(metrics):
+    # Metrics kept only for the columns file stay out of debug.txt
+    if not metrics or not DENSITY_LIMITS:
+        return ""
+
+    return f" ({metrics['peak_nps']:g} nps, {metrics['stream']:.0%} stream, {metrics['jumps']} jumps, {metrics['holds']} holds)"
+
+def open_index():
+    conn = sqlite3.connect(INDEX_FILE)
+    if conn.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+        conn.execute("DROP TABLE IF EXISTS songs")
+        conn.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS songs (
+            pack TEXT NOT NULL,
+            song TEXT NOT NULL,
+            chart_file TEXT,
+            size INTEGER,
+            mtime INTEGER,
+            steps TEXT NOT NULL,
+            PRIMARY KEY (pack, song)
+        )
+    """)
+    return conn
+
+def load_pack_index(conn, pack):
+    entries = {}
+    for song, chart_file, size, mtime, steps in conn.execute("SELECT song, chart_file, size, mtime, steps FROM songs WHERE pack = ? ORDER BY rowid", (pack,)):
+        entries[song] = {
+            "song": song,
+            "chart_file": chart_file,
+            "size": size,
+            "mtime": mtime,
+            "steps": [tuple(step) for step in json.loads(steps)],
+        }
+
+    return entries
+
+def save_pack_index(conn, pack, entries):
+    with conn:
+        conn.execute("DELETE FROM songs WHERE pack = ?", (pack,))
+        conn.executemany(
+            "INSERT INTO songs (pack, song, chart_file, size, mtime, steps) VALUES (?, ?, ?, ?, ?, ?)",
+            [(pack, entry["song"], entry["chart_file"], entry["size"], entry["mtime"], json.dumps(entry["steps"])) for entry in entries]
+        )
+
+def drop_missing_packs(conn, packs):
+    indexed_packs = {pack for pack, in conn.execute("SELECT DISTINCT pack FROM songs")}
+    with conn:
+        conn.executemany("DELETE FROM songs WHERE pack = ?", [(pack,) for pack in indexed_packs - set(packs)])
+
+def get_pack_folders():
+    pack_folders = []
+    with measure("discovery") as stage_stats, os.scandir(SONGS_FOLDER) as entries:
+        stage_stats["folders_scanned"] += 1
+        for entry in entries:
+            if entry.is_dir():
+                pack_folders.append((entry.name, entry.path))
+            elif entry.name.lower().endswith('.zip') and zipfile.is_zipfile(entry.path):
+                # Named with the .zip so a pack extracted next to its archive stays a pack of its own
+                pack_folders.append((entry.name, entry.path))
+
+    return pack_folders
+
+def get_song_folders(pack_folder):
+    with measure("discovery") as stage_stats, os.scandir(pack_folder) as entries:
+        stage_stats["folders_scanned"] += 1
+        return [entry.path for entry in entries if entry.is_dir()]
+
+def is_zip_pack(pack_folder):
+    return pack_folder.lower().endswith('.zip') and not os.path.isdir(pack_folder)
+
+def process_pack(pack_folder, cached_entries):
+    if is_zip_pack(pack_folder):
+        return process_zip_pack(pack_folder, cached_entries)
+
+    return [process_song(song_folder, cached_entries.get(os.path.basename(song_folder))) for song_folder in get_song_folders(pack_folder)]
+
+def process_songs(song_folders, cached_entries):
+    return [process_song(song_folder, cached_entry) for song_folder, cached_entry in zip(song_folders, cached_entries)]
+
+def scan_packs(pack_folders, get_cached_entries):
+    # Yields (pack, song_entries, pack_stats) in pack_folders order, whatever the worker count.
+    # Cached entries are only loaded for the packs in flight, so memory stays flat on big libraries.
+    if WORKER_COUNT <= 1:
+        for pack, pack_folder in pack_folders:
+            yield pack, *collect_stats(process_pack, pack_folder, get_cached_entries(pack))
+        return
+
+    max_pending_tasks = WORKER_COUNT * 4
+    pending_packs = deque()
+    pending_task_count = 0
+
+    with ProcessPoolExecutor(max_workers=WORKER_COUNT) as executor:
+        for pack, pack_folder in pack_folders:
+            cached_entries = get_cached_entries(pack)
+            if SPLIT_BY == "song" and not is_zip_pack(pack_folder):
+                song_folders, pack_stats = collect_stats(get_song_folders, pack_folder)
+                songs_cached_entries = [cached_entries.get(os.path.basename(song_folder)) for song_folder in song_folders]
+                tasks = [
+                    executor.submit(collect_stats, process_songs, song_folders[i:i + SONG_CHUNK_SIZE], songs_cached_entries[i:i + SONG_CHUNK_SIZE])
+                    for i in range(0, len(song_folders), SONG_CHUNK_SIZE)
+                ]
+            else:
+                # Zip packs are read as a whole so each archive is only opened once
+                pack_stats = new_stats()
+                tasks = [executor.submit(collect_stats, process_pack, pack_folder, cached_entries)]
+
+            pending_packs.append((pack, tasks, pack_stats))
+            pending_task_count += len(tasks)
+
+            while pending_task_count > max_pending_tasks:
+                pack, tasks, pack_stats = pending_packs.popleft()
+                pending_task_count -= len(tasks)
+                yield pack, *collect_task_results(tasks, pack_stats)
+
+        while pending_packs:
+            pack, tasks, pack_stats = pending_packs.popleft()
+            yield pack, *collect_task_results(tasks, pack_stats)
+
+def collect_task_results(tasks, pack_stats):
+    song_entries = []
+    for task in tasks:
+        entries, task_stats = task.result()
+        song_entries.extend(entries)
+        add_stats(pack_stats, task_stats)
+
+    return song_entries, pack_stats
+
+def record_stats(report, pack_results):
+    for pack, song_entries, pack_stats in pack_results:
+        report["packs"][pack] = pack_stats
+        add_stats(report["totals"], pack_stats)
+
+        yield pack, song_entries
+
+def write_report(report, start):
+    report["seconds"] = time.perf_counter() - start
+    with open(REPORT_FILE, 'w', encoding='utf-8') as report_file:
+        json.dump(report, report_file, indent=4, ensure_ascii=False)
+
+def start_profile():
+    if os.path.isdir(PROFILE_FOLDER):
+        for file in os.listdir(PROFILE_FOLDER):
+            os.remove(os.path.join(PROFILE_FOLDER, file))
+
+def write_profile():
+    # Every worker process leaves one cumulative profile in PROFILE_FOLDER
+    files = [os.path.join(PROFILE_FOLDER, file) for file in os.listdir(PROFILE_FOLDER)] if os.path.isdir(PROFILE_FOLDER) else []
+    if files:
+        profile = pstats.Stats(*files)
+        profile.dump_stats(PROFILE_FILE)
+        profile.sort_stats("cumulative").print_stats(20)
+
+class OutputFile:
+    # Writes lines as they come, separated without a trailing newline like a '\n'.join would.
+    # Binary so sizes are exact checkpoint offsets, with os.linesep for what a text mode write would give
+    def __init__(self, path, offset=0, create=True):
+        self.path = path
+        self.file = None
+        self.size = 0
+
+        if offset and os.path.exists(path):
+            self.file = open(path, 'r+b')
+            self.file.truncate(offset)
+            self.file.seek(offset)
+            self.size = offset
+        elif create:
+            self.file = open(path, 'wb')
+
+    def write(self, line):
+        if self.file is None:
+            self.file = open(self.path, 'wb')
+
+        text = f"\n{line}" if self.size else line
+        data = text.replace('\n', os.linesep).encode('utf-8')
+        self.file.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+class ResultWriter:
+    # Writes every pack's records as soon as it is scanned and checkpoints it, so a crashed scan can resume
+    def __init__(self, checkpoint=None, use_checkpoint=True):
+        offsets = checkpoint["offsets"] if checkpoint else {}
+        self.outputs = {
+            "debug": OutputFile('debug.txt', offsets.get('debug.txt', 0)),
+            "result": OutputFile('result.txt', offsets.get('result.txt', 0)),
+            "mistake": OutputFile('potential-mistake.txt', offsets.get('potential-mistake.txt', 0), create=False),
+        }
+        if is_finding_duplicates():
+            self.outputs["duplicates"] = OutputFile('duplicates.txt', offsets.get('duplicates.txt', 0))
+
+        self.columns = new_columns()
+        self.notes_index = {}
+        self.checkpoint_file = None
+        if use_checkpoint:
+            self.checkpoint_file = open(CHECKPOINT_FILE, 'a' if checkpoint else 'w', encoding='utf-8')
+
+    def add_pack(self, pack, song_entries, write=True):
+        # write=False replays a pack that was already written before the scan was interrupted
+        duplicates = []
+        for entry in song_entries:
+            is_duplicate, duplicate_lines = add_to_notes_index(self.notes_index, pack, entry) if is_finding_duplicates() else (False, [])
+            duplicates.append(is_duplicate)
+            for line in duplicate_lines if write else []:
+                self.outputs["duplicates"].write(line)
+
+        add_pack_columns(self.columns, pack, song_entries, duplicates)
+        if not write:
+            return
 
         song_count = 0
         parsed_song_count = 0
         valid_chart_count = 0
 
-        for song in os.listdir(pack_folder):
-            song_folder = os.path.join(pack_folder, song)
-            if not os.path.isdir(song_folder):
+        for entry, is_duplicate in zip(song_entries, duplicates):
+            all_dance_single_charts = get_dance_single_charts(entry)
+            for meter, metrics, _ in all_dance_single_charts:
+                self.outputs["debug"].write(f"{pack}/{entry['song']}: {meter}{format_metrics(metrics)}")
+
+            if is_duplicate and SKIP_DUPLICATES:
                 continue
 
             song_count += 1
 
-            valid_charts, all_dance_single_difficulties = process_song(song_folder, pack)
-
-            if all_dance_single_difficulties:
+            if all_dance_single_charts:
                 parsed_song_count += 1
 
-            for pack_name, song_name, meter in all_dance_single_difficulties:
-                debug_lines.append(f"{pack_name}/{song_name}: {meter}")
-
-            if valid_charts:
+            if any(is_valid_chart(meter, metrics) for meter, metrics, _ in all_dance_single_charts):
                 valid_chart_count += 1
 
         if song_count != parsed_song_count:
-            potential_mistakes.append(f"{pack} - Expected: {song_count}, Parsed: {parsed_song_count}")
+            self.outputs["mistake"].write(f"{pack} - Expected: {song_count}, Parsed: {parsed_song_count}")
+
+        if is_selected_pack(song_count, parsed_song_count, valid_chart_count, RIGHT_SONG_PERCENTAGE, MAX_MISTAKE_PERCENTAGE):
+            self.outputs["result"].write(pack)
+
+        for output in self.outputs.values():
+            output.flush()
+
+        if self.checkpoint_file:
+            offsets = {output.path: output.size for output in self.outputs.values()}
+            self.checkpoint_file.write(json.dumps({"pack": pack, "offsets": offsets}, ensure_ascii=False) + '\n')
+            self.checkpoint_file.flush()
+
+    def close(self):
+        for output in self.outputs.values():
+            output.close()
+
+        if WRITE_COLUMNS:
+            save_columns(self.columns)
+
+        if self.checkpoint_file:
+            self.checkpoint_file.close()
+            os.remove(CHECKPOINT_FILE)
+
+def read_checkpoint():
+    if not os.path.exists(CHECKPOINT_FILE):
+        return None
+
+    checkpoint = {"packs": set(), "offsets": {}}
+    with open(CHECKPOINT_FILE, encoding='utf-8') as checkpoint_file:
+        for line in checkpoint_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line is cut off when the scan died while writing it
+                break
+            checkpoint["packs"].add(record["pack"])
+            checkpoint["offsets"] = record["offsets"]
+
+    return checkpoint
+
+def save_scanned_packs(conn, pack_entries):
+    for pack, song_entries in pack_entries:
+        if conn:
+            save_pack_index(conn, pack, song_entries)
+
+        yield pack, song_entries
+
+def load_cached_entries(conn, pack):
+    return load_pack_index(conn, pack) if conn else {}
+
+def main():
+    check_settings()
+    start = time.perf_counter()
+    report = {"seconds": 0.0, "totals": new_stats(), "packs": {}}
+    if PROFILE_PARSERS:
+        start_profile()
+
+    conn = open_index() if USE_INDEX else None
+    # Resuming needs the index to replay the packs that were already written
+    checkpoint = read_checkpoint() if conn else None
+    if checkpoint:
+        print(f"Resuming after {len(checkpoint['packs'])} packs")
+
+    pack_folders, discovery_stats = collect_stats(get_pack_folders)
+    add_stats(report["totals"], discovery_stats)
+
+    completed_packs = checkpoint["packs"] if checkpoint else set()
+    remaining_packs = [(pack, pack_folder) for pack, pack_folder in pack_folders if pack not in completed_packs]
+    scanned_packs = save_scanned_packs(conn, record_stats(report, scan_packs(remaining_packs, partial(load_cached_entries, conn))))
+
+    writer = ResultWriter(checkpoint, use_checkpoint=conn is not None)
+    for pack, _ in pack_folders:
+        if pack in completed_packs:
+            writer.add_pack(pack, list(load_pack_index(conn, pack).values()), write=False)
+        else:
+            writer.add_pack(*next(scanned_packs))
+    writer.close()
+
+    if conn:
+        drop_missing_packs(conn, [pack for pack, _ in pack_folders])
+        conn.close()
+
+    write_report(report, start)
+    if PROFILE_PARSERS:
+        write_profile()
+
+def get_pack_stamp(pack_folder):
+    # A pack folder's mtime changes when songs are added to or removed from it
+    stat = os.stat(pack_folder)
+    return stat.st_mtime_ns, stat.st_size
+
+def watch():
+    # Polls SONGS_FOLDER and only rescans packs that were added or changed
+    check_settings()
+    conn = open_index() if USE_INDEX else None
+    pack_entries = {}
+    pack_stamps = {}
+
+    def get_cached_entries(pack):
+        if conn:
+            return load_pack_index(conn, pack)
+
+        return {entry["song"]: entry for entry in pack_entries.get(pack, [])}
+
+    try:
+        while True:
+            pack_folders = get_pack_folders()
+            stamps = {pack: (pack_folder, get_pack_stamp(pack_folder)) for pack, pack_folder in pack_folders}
+            changed_packs = [(pack, pack_folder) for pack, pack_folder in pack_folders if pack_stamps.get(pack) != stamps[pack]]
+            removed_packs = pack_stamps.keys() - stamps.keys()
+
+            if changed_packs or removed_packs:
+                start = time.perf_counter()
+                report = {"seconds": 0.0, "totals": new_stats(), "packs": {}}
+                for pack, song_entries in save_scanned_packs(conn, record_stats(report, scan_packs(changed_packs, get_cached_entries))):
+                    pack_entries[pack] = song_entries
+                write_report(report, start)
+
+                if conn:
+                    drop_missing_packs(conn, stamps.keys())
+                for pack in removed_packs:
+                    del pack_entries[pack]
+
+                pack_stamps = stamps
+                writer = ResultWriter(use_checkpoint=False)
+                for pack, _ in pack_folders:
+                    writer.add_pack(pack, pack_entries[pack])
+                writer.close()
+                print(f"Rescanned {len(changed_packs)} packs, removed {len(removed_packs)} packs")
+
+            time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if conn:
+            conn.close()
+
+def new_columns():
+    columns = {"packs": [], "songs": [], "song_pack": array('i'), "song_duplicate": array('b'), "chart_song": array('i'), "meter": array('i')}
+    for metric in METRICS:
+        columns[metric] = array('d')
+
+    return columns
+
+def add_pack_columns(columns, pack, song_entries, duplicates):
+    pack_code = len(columns["packs"])
+    columns["packs"].append(pack)
+
+    for entry, is_duplicate in zip(song_entries, duplicates):
+        song_code = len(columns["songs"])
+        columns["songs"].append(entry["song"])
+        columns["song_pack"].append(pack_code)
+        columns["song_duplicate"].append(is_duplicate)
+
+        for meter, metrics, _ in get_dance_single_charts(entry):
+            columns["chart_song"].append(song_code)
+            columns["meter"].append(meter)
+            for metric in METRICS:
+                columns[metric].append(metrics.get(metric, np.nan) if metrics else np.nan)
+
+def save_columns(columns):
+    np.savez(
+        COLUMNS_FILE,
+        packs=np.array(columns["packs"], dtype=str),
+        songs=np.array(columns["songs"], dtype=str),
+        song_pack=np.array(columns["song_pack"], dtype=np.int32),
+        song_duplicate=np.array(columns["song_duplicate"], dtype=bool),
+        chart_song=np.array(columns["chart_song"], dtype=np.int32),
+        meter=np.array(columns["meter"], dtype=np.int32),
+        **{metric: np.array(columns[metric], dtype=np.float64) for metric in METRICS}
+    )
+
+def select_packs_from_columns(columns, min_diff, max_diff, right_song_percentage, max_mistake_percentage, density_limits, skip_duplicates):
+    valid = (columns["meter"] >= min_diff) & (columns["meter"] <= max_diff)
+    for metric, (low, high) in density_limits.items():
+        # Charts whose notes couldn't be analyzed have NaN metrics and never pass
+        if low is not None:
+            valid &= columns[metric] >= low
+        if high is not None:
+            valid &= columns[metric] <= high
+
+    song_count = len(columns["songs"])
+    pack_count = len(columns["packs"])
+    parsed_songs = np.bincount(columns["chart_song"], minlength=song_count) > 0
+    valid_songs = np.bincount(columns["chart_song"][valid], minlength=song_count) > 0
+
+    counted_songs = ~columns["song_duplicate"] if skip_duplicates else np.ones(song_count, dtype=bool)
+    song_counts = np.bincount(columns["song_pack"][counted_songs], minlength=pack_count)
+    parsed_song_counts = np.bincount(columns["song_pack"][parsed_songs & counted_songs], minlength=pack_count)
+    valid_chart_counts = np.bincount(columns["song_pack"][valid_songs & counted_songs], minlength=pack_count)
+
+    return [
+        str(pack) for pack, song_count, parsed_song_count, valid_chart_count
+        in zip(columns["packs"], song_counts.tolist(), parsed_song_counts.tolist(), valid_chart_counts.tolist())
+        if is_selected_pack(song_count, parsed_song_count, valid_chart_count, right_song_percentage, max_mistake_percentage)
+    ]
+
+def query(args):
+    parser = argparse.ArgumentParser(prog="main.py query", description=f"Re-select packs from {COLUMNS_FILE} without rescanning")
+    parser.add_argument("--min-diff", type=int, default=MIN_DIFF)
+    parser.add_argument("--max-diff", type=int, default=MAX_DIFF)
+    parser.add_argument("--right-song-percentage", type=float, default=RIGHT_SONG_PERCENTAGE)
+    parser.add_argument("--max-mistake-percentage", type=float, default=MAX_MISTAKE_PERCENTAGE)
+    parser.add_argument("--skip-duplicates", action=argparse.BooleanOptionalAction, default=SKIP_DUPLICATES)
+    for metric in METRICS:
+        low, high = DENSITY_LIMITS.get(metric, (None, None))
+        parser.add_argument(f"--min-{metric.replace('_', '-')}", type=float, default=low)
+        parser.add_argument(f"--max-{metric.replace('_', '-')}", type=float, default=high)
+    args = parser.parse_args(args)
+
+    density_limits = {}
+    for metric in METRICS:
+        low, high = getattr(args, f"min_{metric}"), getattr(args, f"max_{metric}")
+        if low is not None or high is not None:
+            density_limits[metric] = (low, high)
+
+    with np.load(COLUMNS_FILE) as columns:
+        columns = dict(columns)
 
-        if song_count > 0 and valid_chart_count / song_count < RIGHT_SONG_PERCENTAGE:
-            mistake_percentage = (song_count - parsed_song_count) / song_count
-            if mistake_percentage <= MAX_MISTAKE_PERCENTAGE:
-                result_lines.append(pack)
+    # Charts scanned without metrics have NaN ones, filtering on them would fail every chart
+    missing_metrics = [metric for metric in density_limits if np.isnan(columns[metric]).all() and len(columns[metric])]
+    if missing_metrics:
+        parser.error(f"{COLUMNS_FILE} has no {', '.join(missing_metrics)} values, rescan with USE_BYTE_SCANNER on")
 
-    with open('debug.txt', 'w', encoding='utf-8') as debug_file:
-        debug_file.write('\n'.join(debug_lines))
+    packs = select_packs_from_columns(columns, args.min_diff, args.max_diff, args.right_song_percentage, args.max_mistake_percentage, density_limits, args.skip_duplicates)
+    print('\n'.join(packs))
 
-    with open('result.txt', 'w', encoding='utf-8') as result_file:
-        result_file.write('\n'.join(result_lines))
+def check():
+    # Steady 16th streams have to come out at exactly bpm / 60 * 4 notes per second
+    measure = b'\n'.join([b'1000', b'0100', b'0010', b'0001'] * 4)
+    failures = 0
+    for bpm in [100, 120, 140, 150, 170, 175, 180, 190, 200, 210, 222.5]:
+        peak_nps = analyze_notes(b'\n,\n'.join([measure] * 8), parse_bpms(f"0={bpm}".encode()))["peak_nps"]
+        if peak_nps != round(bpm / 60 * 4, 6):
+            print(f"{bpm} BPM stream: peak_nps {peak_nps}, expected {bpm / 60 * 4}")
+            failures += 1
 
-    if potential_mistakes:
-        with open('potential-mistake.txt', 'w', encoding='utf-8') as mistake_file:
-            mistake_file.write('\n'.join(potential_mistakes))
+    print(f"{failures} failures")
+    sys.exit(1 if failures else 0)
 
-main()
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["query"]:
+        query(sys.argv[2:])
+    elif sys.argv[1:2] == ["check"]:
+        check()
+    elif sys.argv[1:2] == ["watch"]:
+        watch()
+    else:
+        main()
@@ -1,12 +1,14 @@
 import os
 import re
-import pickle
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 from PIL import Image
-import requests
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+from playlist_cache import load_playlist
+from playlist_sync import create_spotify, sync_playlists
+from covers import COVERS_FOLDER, download_covers, get_cover_digest, load_cover_features, save_cover_features
 
 playlist_ids = {
     "trance": "https://open.spotify.com/playlist/50tBRPNUzxkOzlT6KGixdk",
@@ -17,67 +19,113 @@ playlist_ids = {
     "breakcore": "https://open.spotify.com/playlist/05nsmLglaAmlvwZNV4uA2Y",
 }
 
+SYNC_PLAYLISTS = True # True False
+
+COLOR_WORKERS = os.cpu_count() or 1
+COLOR_SAMPLE_STEP = 5
+# Faster decode but averages a downscaled image, so colors can differ slightly from the full size ones
+USE_JPEG_DRAFT = False # True False
+
+# Palette mode, python colors.py palette
+PALETTE_SIZE = 5
+PALETTE_COVER_SIZE = 16
+PALETTE_CHUNK_SIZE = 512
+PALETTE_MAX_PIXELS = 1000000
+KMEANS_BATCH_SIZE = 4096
+KMEANS_ITERATIONS = 50
+KMEANS_TOLERANCE = 0.5
+
 playlists = {}
+playlist_covers = {}
 playlist_track_colors = {}
 playlist_colors = {}
 sp = None
 
-def get_local_playlist(playlist_name):
-    if os.path.exists(f"cache/{playlist_name}.pkl"):
-        with open(f"cache/{playlist_name}.pkl", "rb") as f:
-            return pickle.load(f)
-
-def get_playlist_tracks(playlist_id):
+def get_spotify():
     global sp
 
     if not sp:
-        # Client info is in environment variables
-        creds = SpotifyClientCredentials()
-        sp = spotipy.Spotify(client_credentials_manager=creds)
-
-    try:
-        results = sp.playlist_items(playlist_id)
-        tracks = results['items']
-        while results['next']:
-            results = sp.next(results)
-            tracks.extend(results['items'])
-    except Exception as e:
-        print(f"Error accessing playlist: {str(e)}")
-        return
-    
-    return tracks
-
-def download_playlist_imgs(playlist_name, playlist):
-    for item in playlist:
-        os.makedirs(f"cache/imgs/{playlist_name}", exist_ok=True)
+        sp = create_spotify()
 
-        track = item['track']
+    return sp
 
+def get_track_cover_urls(playlist):
+    track_urls = {}
+    for track in playlist.tracks():
         title = track['name']
-        artists = [artist['name'] for artist in track['artists']]
-        img_url = track['album']['images'][-1]['url']
+        artists = track['artists']
+
+        track_name = f"{', '.join(artists)} - {title}"
+        track_name = re.sub(r'[^a-zA-Z0-9_\- .()~!@#$%^&+=]', '', track_name)
+
+        track_urls[track_name] = track['image_url']
+
+    return track_urls
+
+def download_playlist_covers():
+    # Covers of every playlist are downloaded together so a url shared between playlists is fetched once
+    track_urls = {playlist_name: get_track_cover_urls(playlist) for playlist_name, playlist in playlists.items()}
+    cover_paths = download_covers([url for urls in track_urls.values() for url in urls.values()])
+
+    for playlist_name, urls in track_urls.items():
+        playlist_covers[playlist_name] = {track_name: cover_paths[url] for track_name, url in urls.items() if url in cover_paths}
+
+def map_covers(func, img_paths):
+    # func over every cover, spread over COLOR_WORKERS processes
+    if COLOR_WORKERS > 1 and len(img_paths) > 1:
+        chunk_size = max(1, len(img_paths) // (COLOR_WORKERS * 4))
+        with ProcessPoolExecutor(max_workers=COLOR_WORKERS) as executor:
+            return list(executor.map(func, img_paths, chunksize=chunk_size))
+
+    return [func(img_path) for img_path in img_paths]
+
+def get_color_feature():
+    # Averages depend on how the cover was sampled, so each setting is its own feature
+    return f"avg_color_{COLOR_SAMPLE_STEP}" + ("_draft" if USE_JPEG_DRAFT else "")
+
+def get_cover_colors(img_paths):
+    # Average color of every distinct cover, only covers not in the feature store are decoded
+    feature = get_color_feature()
+    cover_features = load_cover_features()
+
+    img_paths = list(dict.fromkeys(img_paths))
+    new_paths = [img_path for img_path in img_paths if feature not in cover_features.get(get_cover_digest(img_path), {})]
 
-        file_name = f"{', '.join(artists)} - {title}.jpg"
-        file_name = re.sub(r'[^a-zA-Z0-9_\- .()~!@#$%^&+=]', '', file_name)
+    colors = map_covers(get_average_color, new_paths)
+    for img_path, color in zip(new_paths, colors):
+        cover_features.setdefault(get_cover_digest(img_path), {})[feature] = [int(channel) for channel in color]
+    if new_paths:
+        save_cover_features(cover_features)
 
-        file_path = f"cache/imgs/{playlist_name}/{file_name}"
-        if not os.path.exists(file_path):
-            img_data = requests.get(img_url).content
-            with open(file_path, 'wb') as file:
-                file.write(img_data)
+    return {img_path: tuple(cover_features[get_cover_digest(img_path)][feature]) for img_path in img_paths}
 
-def get_track_colors(playlist_name):
+def get_track_colors(playlist_name, cover_colors):
     playlist_track_colors[playlist_name] = {}
-    img_folder = f"cache/imgs/{playlist_name}"
-    for filename in os.listdir(img_folder):
-        if filename.endswith(".jpg"):
-            img_path = os.path.join(img_folder, filename)
-            avg_color = get_average_color(img_path)
-            playlist_track_colors[playlist_name][filename[:-4]] = avg_color
+    for track_name, img_path in playlist_covers[playlist_name].items():
+        playlist_track_colors[playlist_name][track_name] = cover_colors[img_path]
 
 def get_average_color(image_path):
     img = Image.open(image_path)
 
+    step = COLOR_SAMPLE_STEP
+    if USE_JPEG_DRAFT:
+        # Lets the JPEG decoder scale down by up to 8, every decoded pixel is used then
+        img.draft("RGB", (img.width // step, img.height // step))
+        step = 1
+
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    # Same pixels as the old loop, every step-th column of every step-th row
+    pixels = np.asarray(img)[::step, ::step].reshape(-1, 3)
+
+    avg_color = pixels.sum(axis=0, dtype=np.int64) // len(pixels)
+    return tuple(avg_color)
+
+def get_average_color_per_pixel(image_path):
+    # Old get_average_color, kept to benchmark against
+    img = Image.open(image_path)
+
     if img.mode != "RGB":
         img = img.convert("RGB")
 
@@ -88,8 +136,8 @@ def get_average_color(image_path):
     total_color = np.array([0, 0, 0], dtype=int)
     count = 0
 
-    for x in range(0, width, 5):
-        for y in range(0, height, 5):
+    for x in range(0, width, COLOR_SAMPLE_STEP):
+        for y in range(0, height, COLOR_SAMPLE_STEP):
             pixel_color = pixels[x, y]
             total_color += np.array(pixel_color[:3])
             count += 1
@@ -113,24 +161,172 @@ def get_average_color_of_playlist(playlist):
     
     return tuple(playlist_color)
 
+def get_cover_pixels(image_path):
+    # PALETTE_COVER_SIZE x PALETTE_COVER_SIZE box filtered pixels, (pixels, 3) uint8
+    img = Image.open(image_path)
+    img.draft("RGB", (PALETTE_COVER_SIZE, PALETTE_COVER_SIZE))
+
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    img = img.resize((PALETTE_COVER_SIZE, PALETTE_COVER_SIZE), Image.BOX)
+    return np.asarray(img).reshape(-1, 3)
+
+def get_nearest_centers(pixels, centers):
+    # pixels (groups, pixels, 3), centers (groups, k, 3) -> index of the nearest center per pixel
+    # |pixel|^2 is the same for every center, so it's left out
+    distances = (centers ** 2).sum(axis=2)[:, None, :] - 2 * pixels @ centers.transpose(0, 2, 1)
+    return distances.argmin(axis=2)
+
+def count_labels(labels):
+    return (labels[:, :, None] == np.arange(PALETTE_SIZE)).sum(axis=1)
+
+def get_initial_centers(pixels, rng):
+    # Greedy k-means++ seeding of every group at once, each next center is the best of a few pixels
+    # picked with probability proportional to their squared distance from the nearest center so far
+    group_count, pixel_count, _ = pixels.shape
+    groups = np.arange(group_count)
+    trial_count = 2 + int(np.log(PALETTE_SIZE))
+
+    centers = np.empty((group_count, PALETTE_SIZE, 3), dtype=np.float32)
+    centers[:, 0] = pixels[groups, rng.integers(pixel_count, size=group_count)]
+    distances = ((pixels - centers[:, :1]) ** 2).sum(axis=2)
+    for k in range(1, PALETTE_SIZE):
+        cumulative = distances.cumsum(axis=1)
+        targets = rng.random((group_count, trial_count)) * cumulative[:, -1:]
+        picks = np.minimum((cumulative[:, None, :] <= targets[:, :, None]).sum(axis=2), pixel_count - 1)
+
+        # (groups, trials, pixels) distances if each pick became a center, the one lowering the total most wins
+        trial_distances = np.minimum(distances[:, None], ((pixels[:, None] - pixels[groups[:, None], picks][:, :, None]) ** 2).sum(axis=3))
+        best = trial_distances.sum(axis=2).argmin(axis=1)
+
+        centers[:, k] = pixels[groups, picks[groups, best]]
+        distances = trial_distances[groups, best]
+
+    return centers
+
+def get_palettes(pixels, rng):
+    # k-means over every group of pixels at once, pixels is (groups, pixels, 3) uint8.
+    # Groups bigger than a batch are clustered on random mini-batches, so memory stays bounded
+    # Returns (groups, k, 3) uint8 colors and (groups, k) pixel shares, most common color first
+    group_count, pixel_count, _ = pixels.shape
+    batch_size = min(pixel_count, KMEANS_BATCH_SIZE)
+    is_mini_batch = batch_size < pixel_count
+
+    seed_pixels = pixels[:, rng.choice(pixel_count, batch_size, replace=False)] if is_mini_batch else pixels
+    centers = get_initial_centers(seed_pixels.astype(np.float32), rng)
+    totals = np.zeros((group_count, PALETTE_SIZE), dtype=np.float32)
+    for _ in range(KMEANS_ITERATIONS):
+        batch = pixels
+        if is_mini_batch:
+            batch = pixels[:, rng.choice(pixel_count, batch_size, replace=False)]
+        batch = batch.astype(np.float32)
+
+        labels = get_nearest_centers(batch, centers)
+        one_hot = (labels[:, :, None] == np.arange(PALETTE_SIZE)).astype(np.float32)
+        sums = one_hot.transpose(0, 2, 1) @ batch
+        counts = one_hot.sum(axis=1)
+
+        if is_mini_batch:
+            # Every center moves towards its batch mean by batch count / all counts so far
+            totals += counts
+            centers += (sums - counts[:, :, None] * centers) / np.maximum(totals, 1)[:, :, None]
+        else:
+            new_centers = np.where(counts[:, :, None] > 0, sums / np.maximum(counts, 1)[:, :, None], centers)
+            is_converged = np.abs(new_centers - centers).max() < KMEANS_TOLERANCE
+            centers = new_centers
+            if is_converged:
+                break
+
+    counts = np.zeros((group_count, PALETTE_SIZE), dtype=np.int64)
+    for start in range(0, pixel_count, KMEANS_BATCH_SIZE):
+        batch = pixels[:, start:start + KMEANS_BATCH_SIZE].astype(np.float32)
+        counts += count_labels(get_nearest_centers(batch, centers))
+
+    order = np.argsort(-counts, axis=1, kind="stable")
+    colors = np.take_along_axis(centers, order[:, :, None], axis=1).round().clip(0, 255).astype(np.uint8)
+    shares = np.take_along_axis(counts, order, axis=1) / pixel_count
+
+    return colors, shares
+
+def get_cover_palettes(cover_pixels, rng):
+    # Palette of every cover, PALETTE_CHUNK_SIZE covers clustered per call
+    img_paths = list(cover_pixels)
+    cover_palettes = {}
+    for start in range(0, len(img_paths), PALETTE_CHUNK_SIZE):
+        chunk_paths = img_paths[start:start + PALETTE_CHUNK_SIZE]
+        colors, shares = get_palettes(np.stack([cover_pixels[img_path] for img_path in chunk_paths]), rng)
+        for img_path, cover_colors, cover_shares in zip(chunk_paths, colors, shares):
+            # Covers with fewer distinct colors than PALETTE_SIZE leave some centers empty
+            cover_palettes[img_path] = cover_colors[cover_shares > 0]
+
+    return cover_palettes
+
+def get_playlist_palette(covers, cover_pixels, rng):
+    # All track covers stacked, each cover cut down to a random subset of its pixels when
+    # the whole stack would not fit in PALETTE_MAX_PIXELS
+    img_paths = list(covers.values())
+    cover_pixel_count = PALETTE_COVER_SIZE * PALETTE_COVER_SIZE
+    sample_count = max(1, min(cover_pixel_count, PALETTE_MAX_PIXELS // len(img_paths)))
+
+    pixels = np.empty((len(img_paths), sample_count, 3), dtype=np.uint8)
+    for i, img_path in enumerate(img_paths):
+        sample = cover_pixels[img_path]
+        if sample_count < cover_pixel_count:
+            sample = sample[rng.choice(cover_pixel_count, sample_count, replace=False)]
+        pixels[i] = sample
+
+    colors, shares = get_palettes(pixels.reshape(1, -1, 3), rng)
+    return colors[0], shares[0]
+
+def to_hex(color):
+    return "#" + "".join(f"{channel:02x}" for channel in color)
+
+def write_palettes():
+    rng = np.random.default_rng(0)
+
+    img_paths = list(dict.fromkeys(img_path for covers in playlist_covers.values() for img_path in covers.values()))
+    cover_pixels = dict(zip(img_paths, map_covers(get_cover_pixels, img_paths)))
+    cover_palettes = get_cover_palettes(cover_pixels, rng)
+
+    os.makedirs("results/colors", exist_ok=True)
+    for playlist_name, covers in playlist_covers.items():
+        if not covers:
+            continue
+
+        colors, shares = get_playlist_palette(covers, cover_pixels, rng)
+        print(f"{playlist_name}: {' '.join(f'{to_hex(color)} ({share:.0%})' for color, share in zip(colors, shares))}")
+
+        swatches = Image.new("RGB", (64 * PALETTE_SIZE, 64))
+        for i, color in enumerate(colors):
+            swatches.paste(tuple(int(channel) for channel in color), (64 * i, 0, 64 * (i + 1), 64))
+        swatches.save(f"results/colors/{playlist_name}_palette.jpg")
+
+        with open(f"results/colors/{playlist_name}_palettes.txt", "w") as f:
+            for track_name, img_path in covers.items():
+                f.write(f"{track_name} || {' '.join(to_hex(color) for color in cover_palettes[img_path])}\n")
+
 def create_playlists():
     os.makedirs("cache", exist_ok=True)
 
-    for playlist_name in playlist_ids.keys():
-        playlists[playlist_name] = get_local_playlist(playlist_name)
+    outdated_ids = {}
+    for playlist_name, playlist_id in playlist_ids.items():
+        playlists[playlist_name] = load_playlist(playlist_name)
+        if SYNC_PLAYLISTS or not playlists[playlist_name]:
+            outdated_ids[playlist_name] = playlist_id
 
-    for playlist_name, playlist in playlists.items():
-        if not playlist:
-            playlist = get_playlist_tracks(playlist_ids[playlist_name])
-            playlists[playlist_name] = playlist
-            with open(f"cache/{playlist_name}.pkl", "wb") as f:
-                pickle.dump(playlist, f)
+    if outdated_ids:
+        # Without credentials or a connection the cached playlists are used as they are
+        try:
+            playlists.update(sync_playlists(get_spotify(), outdated_ids))
+        except Exception as e:
+            print(f"Error accessing Spotify: {str(e)}")
 
-    for playlist_name, playlist in playlists.items():
-        download_playlist_imgs(playlist_name, playlist)
+    download_playlist_covers()
     
+    cover_colors = get_cover_colors(img_path for covers in playlist_covers.values() for img_path in covers.values())
     for playlist_name in playlists.keys():
-        get_track_colors(playlist_name)
+        get_track_colors(playlist_name, cover_colors)
 
     for playlist_name, playlist in playlist_track_colors.items():
         playlist_colors[playlist_name] = get_average_color_of_playlist(playlist)
@@ -145,5 +341,36 @@ def main():
         color_img = Image.new("RGB", (64, 64), color)
         color_img.save(f"results/colors/{playlist_name}.jpg")
 
+def palette():
+    create_playlists()
+    write_palettes()
+
+def benchmark():
+    img_paths = sorted(f"{COVERS_FOLDER}/{file_name}" for file_name in os.listdir(COVERS_FOLDER) if file_name.endswith(".jpg"))
+
+    start = time.perf_counter()
+    old_colors = [get_average_color_per_pixel(img_path) for img_path in img_paths]
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new_colors = [get_average_color(img_path) for img_path in img_paths]
+    new_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=COLOR_WORKERS) as executor:
+        list(executor.map(get_average_color, img_paths, chunksize=max(1, len(img_paths) // (COLOR_WORKERS * 4))))
+    pool_time = time.perf_counter() - start
+
+    mismatches = sum(old_color != new_color for old_color, new_color in zip(old_colors, new_colors))
+    print(f"{len(img_paths)} covers, {mismatches} mismatches")
+    print(f"per pixel: {old_time:.3f}s")
+    print(f"vectorized: {new_time:.3f}s")
+    print(f"vectorized, {COLOR_WORKERS} processes: {pool_time:.3f}s")
+
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
+    elif sys.argv[1:] == ["palette"]:
+        palette()
+    else:
+        main()
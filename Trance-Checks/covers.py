@@ -0,0 +1,108 @@
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from urllib3.util.retry import Retry
+
+COVERS_FOLDER = "cache/covers"
+URLS_FILE = f"{COVERS_FOLDER}/urls.json"
+FEATURES_FILE = f"{COVERS_FOLDER}/features.json"
+COVER_WORKERS = 16
+COVER_RETRIES = 3
+COVER_TIMEOUT = 10
+
+# Covers are stored once per content hash, urls.json maps every image url to its hash
+# so tracks sharing an album share one file and one download
+
+def create_session():
+    session = requests.Session()
+    retries = Retry(total=COVER_RETRIES, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=COVER_WORKERS, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+def get_cover_path(digest):
+    return f"{COVERS_FOLDER}/{digest}.jpg"
+
+def load_cover_urls():
+    if os.path.exists(URLS_FILE):
+        with open(URLS_FILE) as f:
+            return json.load(f)
+
+    return {}
+
+def save_cover_urls(cover_urls):
+    temp_path = f"{URLS_FILE}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(cover_urls, f)
+    os.replace(temp_path, URLS_FILE)
+
+def get_cover_digest(cover_path):
+    # Covers are named by their content hash
+    return os.path.splitext(os.path.basename(cover_path))[0]
+
+def load_cover_features():
+    # digest -> {feature name: value}, for anything computed from a cover that's worth keeping
+    if os.path.exists(FEATURES_FILE):
+        with open(FEATURES_FILE) as f:
+            return json.load(f)
+
+    return {}
+
+def save_cover_features(cover_features):
+    os.makedirs(COVERS_FOLDER, exist_ok=True)
+    temp_path = f"{FEATURES_FILE}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(cover_features, f)
+    os.replace(temp_path, FEATURES_FILE)
+
+def download_cover(session, url):
+    response = session.get(url, timeout=COVER_TIMEOUT)
+    response.raise_for_status()
+
+    data = response.content
+    digest = hashlib.sha1(data).hexdigest()
+    path = get_cover_path(digest)
+    if not os.path.exists(path):
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    return digest
+
+def download_covers(urls):
+    # Returns url -> cover path for every url that is or could be downloaded, failures are reported and left out
+    os.makedirs(COVERS_FOLDER, exist_ok=True)
+    cover_urls = load_cover_urls()
+
+    missing_urls = [
+        url for url in dict.fromkeys(urls)
+        if url and (url not in cover_urls or not os.path.exists(get_cover_path(cover_urls[url])))
+    ]
+
+    failed_urls = {}
+    if missing_urls:
+        session = create_session()
+        with ThreadPoolExecutor(max_workers=COVER_WORKERS) as executor:
+            futures = {url: executor.submit(download_cover, session, url) for url in missing_urls}
+
+        for url, future in futures.items():
+            try:
+                cover_urls[url] = future.result()
+            except Exception as e:
+                cover_urls.pop(url, None)
+                failed_urls[url] = str(e)
+
+        save_cover_urls(cover_urls)
+
+    if failed_urls:
+        print(f"Failed to download {len(failed_urls)} of {len(missing_urls)} covers:")
+        for url, error in failed_urls.items():
+            print(f"{url} || {error}")
+
+    return {url: get_cover_path(cover_urls[url]) for url in urls if url in cover_urls}
@@ -0,0 +1,16 @@
+import pandas as pd
+
+EXPORT_FILES = ["data/dj_kbot_trance.csv"]
+EXPORT_CHUNK_SIZE = 10000
+# Only these columns of the playlist exports are ever read
+EXPORT_DTYPES = {
+    "Track Name": "string",
+    "Artist Name(s)": "string",
+    "Genres": "category",
+}
+
+def read_export_chunks(columns, export_files=EXPORT_FILES):
+    # DataFrames of at most EXPORT_CHUNK_SIZE rows from every export in turn, so memory doesn't grow with the exports
+    dtypes = {column: EXPORT_DTYPES[column] for column in columns}
+    for export_file in export_files:
+        yield from pd.read_csv(export_file, usecols=columns, dtype=dtypes, chunksize=EXPORT_CHUNK_SIZE)
@@ -1,9 +1,11 @@
 import os
 import re
-import pickle
+from array import array
+import numpy as np
 import pandas as pd
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+from playlist_cache import load_playlist
+from playlist_sync import create_spotify, sync_playlists
+from exports import EXPORT_FILES, read_export_chunks
 
 TITLE_WORD_BLACKLIST = [
     "mix", "mixed", "remix", "edit",
@@ -22,6 +24,8 @@ playlist_ids = {
     "temp_vocal": "https://open.spotify.com/playlist/13Lq2Y3hAy8aEzlzWEZ3fC",
 }
 
+SYNC_PLAYLISTS = True # True False
+
 playlists = {}
 playlist_tracks = {}
 sp = None
@@ -40,39 +44,18 @@ intentionally_deleted_tracks = [
     "Paul Denton - Tremor",
 ]
 
-def get_local_playlist(playlist_name):
-    if os.path.exists(f"cache/{playlist_name}.pkl"):
-        with open(f"cache/{playlist_name}.pkl", "rb") as f:
-            return pickle.load(f)
-
-def get_playlist_tracks(playlist_id):
+def get_spotify():
     global sp
 
     if not sp:
-        # Client info is in environment variables
-        creds = SpotifyClientCredentials()
-        sp = spotipy.Spotify(client_credentials_manager=creds)
-
-    try:
-        results = sp.playlist_items(playlist_id)
-        tracks = results['items']
-        while results['next']:
-            results = sp.next(results)
-            tracks.extend(results['items'])
-    except Exception as e:
-        print(f"Error accessing playlist: {str(e)}")
-        return
-    
-    return tracks
+        sp = create_spotify()
+
+    return sp
 
 def playlist_to_tracks(playlist):
     tracks = []
-    for item in playlist:
-        track = item['track']
-
-        title = track['name']
+    for title, artists in zip(playlist.column("name"), playlist.artists()):
         title = sanitize_title(title)
-        artists = [artist['name'] for artist in track['artists']]
         artists = sanitize_artists(artists)
 
         tracks.append({
@@ -102,15 +85,18 @@ def sanitize_artists(artists):
 def create_playlists():
     os.makedirs("cache", exist_ok=True)
 
-    for playlist_name in playlist_ids.keys():
-        playlists[playlist_name] = get_local_playlist(playlist_name)
+    outdated_ids = {}
+    for playlist_name, playlist_id in playlist_ids.items():
+        playlists[playlist_name] = load_playlist(playlist_name)
+        if SYNC_PLAYLISTS or not playlists[playlist_name]:
+            outdated_ids[playlist_name] = playlist_id
 
-    for playlist_name, playlist in playlists.items():
-        if not playlist:
-            playlist = get_playlist_tracks(playlist_ids[playlist_name])
-            playlists[playlist_name] = playlist
-            with open(f"cache/{playlist_name}.pkl", "wb") as f:
-                pickle.dump(playlist, f)
+    if outdated_ids:
+        # Without credentials or a connection the cached playlists are used as they are
+        try:
+            playlists.update(sync_playlists(get_spotify(), outdated_ids))
+        except Exception as e:
+            print(f"Error accessing Spotify: {str(e)}")
 
     for playlist_name, playlist in playlists.items():
         playlist_tracks[playlist_name] = playlist_to_tracks(playlist)
@@ -200,14 +186,95 @@ def find_dupes():
             print(line)
             f.write(f"{line}\n")
 
+class GenreIndex:
+    # Genre vocabulary plus the (track, genre) pairs of a sparse track x genre matrix,
+    # queries are substring tests over the vocabulary turned into track masks.
+    # Chunks of an export can be added one after another, their tracks are numbered on from the last chunk
+    def __init__(self, genres=()):
+        self.track_count = 0
+        self.vocabulary_codes = {}
+        self.tagged_tracks = array('b')
+        self.track_ids = array('q')
+        self.genre_codes = array('q')
+        self.genre_masks = {}
+        self.add(genres)
+
+    def add(self, genres):
+        genres = pd.Series(genres, dtype=object).reset_index(drop=True)
+        tagged = genres.notna().to_numpy()
+
+        track_genres = genres[tagged].str.lower().str.split(",").explode().str.strip()
+        track_genres = track_genres[track_genres != ""]
+        codes, vocabulary = pd.factorize(track_genres)
+        vocabulary_codes = np.array([self.vocabulary_codes.setdefault(genre, len(self.vocabulary_codes)) for genre in vocabulary], dtype=np.int64)
+
+        self.tagged_tracks.frombytes(tagged.astype(np.int8).tobytes())
+        self.track_ids.frombytes((track_genres.index.to_numpy(dtype=np.int64) + self.track_count).tobytes())
+        self.genre_codes.frombytes(vocabulary_codes[codes].tobytes())
+        self.track_count += len(genres)
+        self.genre_masks = {}
+
+    # Copies, a view would keep add from growing the arrays
+    @property
+    def vocabulary(self):
+        return pd.Index(list(self.vocabulary_codes), dtype=object)
+
+    @property
+    def tagged(self):
+        return np.frombuffer(self.tagged_tracks, dtype=np.int8).astype(bool)
+
+    @property
+    def tracks(self):
+        return np.frombuffer(self.track_ids, dtype=np.int64).copy()
+
+    @property
+    def genres(self):
+        return np.frombuffer(self.genre_codes, dtype=np.int64).copy()
+
+    def get_genre_mask(self, substring):
+        substring = substring.lower()
+        if substring not in self.genre_masks:
+            self.genre_masks[substring] = np.asarray(self.vocabulary.str.contains(substring, regex=False), dtype=bool)
+
+        return self.genre_masks[substring]
+
+    def has_genre(self, substring):
+        # Tracks with at least one genre containing substring
+        mask = np.zeros(self.track_count, dtype=bool)
+        mask[self.tracks[self.get_genre_mask(substring)[self.genres]]] = True
+        return mask
+
+    def any(self, *substrings):
+        mask = np.zeros(self.track_count, dtype=bool)
+        for substring in substrings:
+            mask |= self.has_genre(substring)
+        return mask
+
+    def all(self, *substrings):
+        mask = np.ones(self.track_count, dtype=bool)
+        for substring in substrings:
+            mask &= self.has_genre(substring)
+        return mask
+
+    def none(self, *substrings):
+        return ~self.any(*substrings)
+
 def find_missing():
-    old_playlist = pd.read_csv('data/dj_kbot_trance.csv')
-    for _, row in old_playlist.iterrows():
-        if not isinstance(row['Genres'], str):
-            continue
-        
-        if not any("trance" in genre.lower() for genre in row['Genres'].split(",")):
-            print(f"{row['Artist Name(s)']} - {row['Track Name']} || {row['Genres']}")
+    # One genre index per export, built from the Genres column alone,
+    # the rest is only streamed afterwards to print the tracks that were picked
+    for export_file in EXPORT_FILES:
+        genre_index = GenreIndex()
+        for old_playlist in read_export_chunks(["Genres"], [export_file]):
+            genre_index.add(old_playlist['Genres'])
+
+        not_trance = genre_index.tagged & genre_index.none("trance")
+
+        start = 0
+        for old_playlist in read_export_chunks(["Track Name", "Artist Name(s)", "Genres"], [export_file]):
+            picked = old_playlist[not_trance[start:start + len(old_playlist)]]
+            for artists, title, genres in zip(picked['Artist Name(s)'], picked['Track Name'], picked['Genres']):
+                print(f"{artists} - {title} || {genres}")
+            start += len(old_playlist)
 
 if __name__ == "__main__":
     # find_dupes()
@@ -1,9 +1,18 @@
 import os
 import re
-import pickle
+import sys
+import zlib
+import argparse
+import threading
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import numpy as np
 import pandas as pd
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+from playlist_cache import load_playlist
+from playlist_sync import create_spotify, sync_playlists
+from exports import read_export_chunks
 
 TITLE_WORD_BLACKLIST = [
     "mix", "mixed", "remix", "edit",
@@ -13,6 +22,10 @@ TITLE_WORD_BLACKLIST = [
     "asot"
 ]
 blacklist_str = "|".join(TITLE_WORD_BLACKLIST)
+TITLE_CHARS_PATTERN = re.compile(r'[^a-zA-Z0-9 ]')
+ARTIST_CHARS_PATTERN = re.compile(r'[^a-zA-Z0-9, ]')
+BLACKLIST_PATTERN = re.compile(r'\b(?:' + blacklist_str + r')\b')
+WHITESPACE_PATTERN = re.compile(r'\s+')
 
 playlist_ids = {
     "trance": "https://open.spotify.com/playlist/50tBRPNUzxkOzlT6KGixdk",
@@ -21,8 +34,28 @@ playlist_ids = {
     "uplifting": "https://open.spotify.com/playlist/0D7KTFSRmsJDofhdkhEBCk",
 }
 
+TITLE_NGRAM_SIZE = 3
+
+# Fuzzy matching, pairs sharing any LSH band of their title and artist shingles are candidates,
+# they match when their titles are FUZZY_THRESHOLD similar and any two of their artists FUZZY_ARTIST_THRESHOLD.
+# Similarity is the Dice coefficient of space padded trigrams, so a one letter typo still clears 0.6
+FUZZY_THRESHOLD = 0.6
+FUZZY_ARTIST_THRESHOLD = 0.6
+MINHASH_COUNT = 128
+LSH_ROWS = 4
+MINHASH_PRIME = 4294967311
+MINHASH_SEED = 0
+MINHASH_CHUNK_SIZE = 2048
+
+SYNC_PLAYLISTS = True # True False
+
 playlists = {}
 playlist_tracks = {}
+artist_names = []
+artist_name_ids = {}
+playlist_indexes = {}
+playlist_lsh_indexes = {}
+playlists_lock = threading.Lock()
 sp = None
 
 intentionally_deleted_tracks = [
@@ -45,85 +78,144 @@ intentionally_deleted_tracks = [
     "Majai, Alex M.O.R.P.H. - Phoria (ASOT 1151) - Alex M.O.R.P.H. Remix",
 ]
 
-def get_local_playlist(playlist_name):
-    if os.path.exists(f"cache/{playlist_name}.pkl"):
-        with open(f"cache/{playlist_name}.pkl", "rb") as f:
-            return pickle.load(f)
-
-def get_playlist_tracks(playlist_id):
+def get_spotify():
     global sp
 
     if not sp:
-        # Client info is in environment variables
-        creds = SpotifyClientCredentials()
-        sp = spotipy.Spotify(client_credentials_manager=creds)
-
-    try:
-        results = sp.playlist_items(playlist_id)
-        tracks = results['items']
-        while results['next']:
-            results = sp.next(results)
-            tracks.extend(results['items'])
-    except Exception as e:
-        print(f"Error accessing playlist: {str(e)}")
-        return
-    
-    return tracks
+        sp = create_spotify()
+
+    return sp
+
+class TrackStore:
+    # Sanitized tracks of a playlist as parallel arrays, titles and albums are interned
+    # and artists are ids into the artist_names table shared by every playlist
+    __slots__ = ("ids", "titles", "albums", "artist_ids", "artist_offsets")
+
+    def __init__(self, ids, titles, albums, artist_lists):
+        self.ids = ids
+        self.titles = [sys.intern(title) for title in titles]
+        self.albums = [sys.intern(album) for album in albums]
+        self.artist_ids = array('i')
+        self.artist_offsets = array('q', [0])
+        for artists in artist_lists:
+            self.artist_ids.extend(get_artist_id(artist) for artist in artists)
+            self.artist_offsets.append(len(self.artist_ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_artist_ids(self, i):
+        return self.artist_ids[self.artist_offsets[i]:self.artist_offsets[i + 1]]
+
+    def get_artists(self, i):
+        return [artist_names[artist_id] for artist_id in self.get_artist_ids(i)]
+
+def get_artist_id(artist):
+    if artist not in artist_name_ids:
+        artist_name_ids[artist] = len(artist_names)
+        artist_names.append(artist)
+
+    return artist_name_ids[artist]
 
 def playlist_to_tracks(playlist):
-    tracks = []
-    for item in playlist:
-        track = item['track']
+    ids = playlist.column("id")
+    names = playlist.column("name")
+    albums = playlist.column("album")
+    artists = sanitize_artist_lists(playlist.artists())
 
-        title = track['name']
-        title = sanitize_title(title)
-        artists = [artist['name'] for artist in track['artists']]
-        artists = sanitize_artists(artists)
-        album = track['album']['name']
-        album = sanitize_title(album)
+    titles = sanitize_titles(names + albums)
+    titles, albums = titles[:len(names)], titles[len(names):]
 
-        tracks.append({
-            "id": track['id'],
-            "title": title,
-            "artists": artists,
-            "album": album
-        })
+    return TrackStore(ids, titles, albums, artists)
 
-    return tracks
+def sanitize_titles(titles):
+    # Titles cut at " - ", lowercased and without punctuation or blacklisted words, for a whole list or Series at once
+    titles = pd.Series(titles, dtype=object)
+    if titles.empty:
+        return []
 
-def sanitize_title(title):
-    title = title.split(" - ")[0]
-    title = re.sub(r'[^a-zA-Z0-9 ]', '', title).lower()
-    title = re.sub(r'\b(?:' + blacklist_str + r')\b', '', title)
-    title = re.sub(r'\s+', ' ', title).strip()
+    titles = titles.str.split(" - ", n=1).str[0]
+    titles = titles.str.replace(TITLE_CHARS_PATTERN, '', regex=True).str.lower()
+    titles = titles.str.replace(BLACKLIST_PATTERN, '', regex=True)
+    titles = titles.str.replace(WHITESPACE_PATTERN, ' ', regex=True).str.strip()
 
-    return title
+    return titles.tolist()
 
-def sanitize_artists(artists):
-    for i, artist in enumerate(artists):
-        artist = re.sub(r'[^a-zA-Z0-9, ]', '', artist).lower()
-        artist = re.sub(r'\s+', ' ', artist).strip()
+@lru_cache(maxsize=None)
+def sanitize_artist(artist):
+    artist = ARTIST_CHARS_PATTERN.sub('', artist).lower()
+    artist = WHITESPACE_PATTERN.sub(' ', artist).strip()
 
-        artists[i] = artist
+    return artist
 
-    return artists
+def sanitize_artist_lists(artist_lists):
+    return [[sanitize_artist(artist) for artist in artists] for artists in artist_lists]
 
 def create_playlists():
-    os.makedirs("cache", exist_ok=True)
-
-    for playlist_name in playlist_ids.keys():
-        playlists[playlist_name] = get_local_playlist(playlist_name)
+    # Playlists are loaded and sanitized once, every report after the first reuses them and their indexes
+    with playlists_lock:
+        if not playlist_tracks:
+            load_playlists()
 
-    for playlist_name, playlist in playlists.items():
-        if not playlist:
-            playlist = get_playlist_tracks(playlist_ids[playlist_name])
-            playlists[playlist_name] = playlist
-            with open(f"cache/{playlist_name}.pkl", "wb") as f:
-                pickle.dump(playlist, f)
+def load_playlists():
+    os.makedirs("cache", exist_ok=True)
 
+    outdated_ids = {}
+    for playlist_name, playlist_id in playlist_ids.items():
+        playlists[playlist_name] = load_playlist(playlist_name)
+        if SYNC_PLAYLISTS or not playlists[playlist_name]:
+            outdated_ids[playlist_name] = playlist_id
+
+    if outdated_ids:
+        # Without credentials or a connection the cached playlists are used as they are
+        try:
+            playlists.update(sync_playlists(get_spotify(), outdated_ids))
+        except Exception as e:
+            print(f"Error accessing Spotify: {str(e)}")
+
+    playlist_indexes.clear()
+    playlist_lsh_indexes.clear()
+    artist_names.clear()
+    artist_name_ids.clear()
     for playlist_name, playlist in playlists.items():
         playlist_tracks[playlist_name] = playlist_to_tracks(playlist)
 
+def get_title_ngrams(title):
+    return {title[i:i + TITLE_NGRAM_SIZE] for i in range(len(title) - TITLE_NGRAM_SIZE + 1)}
+
+def get_track_index(playlist_name):
+    if playlist_name in playlist_indexes:
+        return playlist_indexes[playlist_name]
+
+    artist_index = {}
+    title_index = {}
+    tracks = playlist_tracks[playlist_name]
+    for i, title in enumerate(tracks.titles):
+        for artist_id in set(tracks.get_artist_ids(i)):
+            artist_index.setdefault(artist_id, set()).add(i)
+        for ngram in get_title_ngrams(title):
+            title_index.setdefault(ngram, set()).add(i)
+
+    playlist_indexes[playlist_name] = (artist_index, title_index)
+    return playlist_indexes[playlist_name]
+
+def find_track_matches(main_tracks, main_i, playlist_name):
+    # Indexes of the tracks whose title contains the main track's title and that share an artist with it, in playlist order
+    artist_index, title_index = get_track_index(playlist_name)
+    tracks = playlist_tracks[playlist_name]
+    main_title = main_tracks.titles[main_i]
+
+    candidates = set()
+    for artist_id in main_tracks.get_artist_ids(main_i):
+        candidates |= artist_index.get(artist_id, set())
+
+    ngrams = get_title_ngrams(main_title)
+    if ngrams and candidates:
+        rarest_ngram = min(ngrams, key=lambda ngram: len(title_index.get(ngram, ())))
+        candidates &= title_index.get(rarest_ngram, set())
+
+    return [i for i in sorted(candidates) if main_title in tracks.titles[i]]
+
 def get_matches(main_playlist):
     main_tracks = playlist_tracks[main_playlist]
     matches = {}
@@ -131,22 +223,16 @@ def get_matches(main_playlist):
 
     for playlist_name, tracks in playlist_tracks.items():
         matches[playlist_name] = {}
-        for main_track in main_tracks:
-            main_id = main_track["id"]
-
-            for track in tracks:
-                track_id = track["id"]
+        for main_i, main_id in enumerate(main_tracks.ids):
+            for i in find_track_matches(main_tracks, main_i, playlist_name):
+                track_id = tracks.ids[i]
                 track_pair = frozenset([main_id, track_id])
 
                 if main_id == track_id or track_pair in seen_pairs:
                     continue
 
-                if main_track["title"] in track["title"]:
-                    for artist in main_track["artists"]:
-                        if artist in track["artists"]:
-                            matches[playlist_name][main_id + track_id] = (main_track, track)
-                            seen_pairs.add(track_pair)
-                            break
+                matches[playlist_name][main_id + track_id] = (main_i, i)
+                seen_pairs.add(track_pair)
         
         if len(matches[playlist_name]) == 0:
             del matches[playlist_name]
@@ -157,63 +243,217 @@ def write_matches(main_playlist, matches):
     lines = []
     lines.append(f"===============================")
     lines.append(f"Main playlist: {main_playlist}")
+    main_tracks = playlist_tracks[main_playlist]
     for playlist_name, matches in matches.items():
         lines.append(f"Matches for {playlist_name}:")
 
-        for match in matches.values():
-            main_track = match[0]
-            track = match[1]
-            lines.append(f"{main_track['title']} VS {track['title']} || {main_track['artists']} VS {track['artists']}")
+        tracks = playlist_tracks[playlist_name]
+        for main_i, i in matches.values():
+            lines.append(f"{main_tracks.titles[main_i]} VS {tracks.titles[i]} || {main_tracks.get_artists(main_i)} VS {tracks.get_artists(i)}")
         
         lines.append("")
     
     return lines
 
+def get_fuzzy_ngrams(text):
+    # Padded so the first and last letters are in as many trigrams as the rest
+    padding = " " * (TITLE_NGRAM_SIZE - 1)
+    return get_title_ngrams(f"{padding}{text}{padding}")
+
+def get_similarity(ngrams, other_ngrams):
+    return 2 * len(ngrams & other_ngrams) / (len(ngrams) + len(other_ngrams))
+
+def get_artist_similarity(artist_ngram_sets, other_artist_ngram_sets):
+    return max((get_similarity(ngrams, other_ngrams) for ngrams in artist_ngram_sets for other_ngrams in other_artist_ngram_sets), default=0.0)
+
+def get_track_shingles(title_ngrams, artist_ngram_sets):
+    # Title and artist trigrams, tagged so a title trigram never equals an artist one
+    shingles = {f"t{ngram}" for ngram in title_ngrams}
+    for ngrams in artist_ngram_sets:
+        shingles |= {f"a{ngram}" for ngram in ngrams}
+
+    return shingles
+
+def get_minhash_signatures(shingle_sets):
+    rng = np.random.default_rng(MINHASH_SEED)
+    a = rng.integers(1, 2 ** 31, MINHASH_COUNT, dtype=np.uint64)
+    b = rng.integers(0, MINHASH_PRIME, MINHASH_COUNT, dtype=np.uint64)
+
+    signatures = np.empty((len(shingle_sets), MINHASH_COUNT), dtype=np.uint64)
+    for start in range(0, len(shingle_sets), MINHASH_CHUNK_SIZE):
+        chunk = shingle_sets[start:start + MINHASH_CHUNK_SIZE]
+        hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingles in chunk for shingle in shingles], dtype=np.uint64)
+        offsets = np.cumsum([0] + [len(shingles) for shingles in chunk[:-1]])
+
+        permuted = (a[:, None] * hashes[None, :] + b[:, None]) % MINHASH_PRIME
+        signatures[start:start + len(chunk)] = np.minimum.reduceat(permuted, offsets, axis=1).T
+
+    return signatures
+
+def get_band_keys(signature):
+    bands = signature.reshape(-1, LSH_ROWS)
+    return [(band, bands[band].tobytes()) for band in range(len(bands))]
+
+def get_lsh_index(playlist_name):
+    if playlist_name in playlist_lsh_indexes:
+        return playlist_lsh_indexes[playlist_name]
+
+    tracks = playlist_tracks[playlist_name]
+    # The combined shingles only pick the candidates, titles and artists are scored on their own
+    title_ngram_sets = [get_fuzzy_ngrams(title) for title in tracks.titles]
+    artist_ngram_sets = [[get_fuzzy_ngrams(artist) for artist in tracks.get_artists(i)] for i in range(len(tracks))]
+    signatures = get_minhash_signatures([get_track_shingles(*ngram_sets) for ngram_sets in zip(title_ngram_sets, artist_ngram_sets)])
+
+    buckets = {}
+    for i, signature in enumerate(signatures):
+        for band_key in get_band_keys(signature):
+            buckets.setdefault(band_key, []).append(i)
+
+    playlist_lsh_indexes[playlist_name] = (title_ngram_sets, artist_ngram_sets, signatures, buckets)
+    return playlist_lsh_indexes[playlist_name]
+
+def get_fuzzy_matches(main_playlist):
+    main_tracks = playlist_tracks[main_playlist]
+    main_title_ngram_sets, main_artist_ngram_sets, main_signatures, _ = get_lsh_index(main_playlist)
+    matches = {}
+    seen_pairs = set()
+
+    for playlist_name, tracks in playlist_tracks.items():
+        title_ngram_sets, artist_ngram_sets, _, buckets = get_lsh_index(playlist_name)
+        matches[playlist_name] = {}
+        for main_i, (main_id, main_title_ngrams, signature) in enumerate(zip(main_tracks.ids, main_title_ngram_sets, main_signatures)):
+            candidates = set()
+            for band_key in get_band_keys(signature):
+                candidates.update(buckets.get(band_key, ()))
+
+            for i in sorted(candidates):
+                track_id = tracks.ids[i]
+                track_pair = frozenset([main_id, track_id])
+
+                if main_id == track_id or track_pair in seen_pairs:
+                    continue
+
+                score = get_similarity(main_title_ngrams, title_ngram_sets[i])
+                if score < FUZZY_THRESHOLD:
+                    continue
+                if get_artist_similarity(main_artist_ngram_sets[main_i], artist_ngram_sets[i]) < FUZZY_ARTIST_THRESHOLD:
+                    continue
+
+                matches[playlist_name][main_id + track_id] = (main_i, i, score)
+                seen_pairs.add(track_pair)
+
+        if len(matches[playlist_name]) == 0:
+            del matches[playlist_name]
+
+    return matches
+
+def write_fuzzy_matches(main_playlist, matches):
+    lines = []
+    lines.append(f"===============================")
+    lines.append(f"Main playlist: {main_playlist}")
+    main_tracks = playlist_tracks[main_playlist]
+    for playlist_name, matches in matches.items():
+        lines.append(f"Matches for {playlist_name}:")
+
+        tracks = playlist_tracks[playlist_name]
+        for main_i, i, score in matches.values():
+            lines.append(f"{score:.2f} || {main_tracks.titles[main_i]} VS {tracks.titles[i]} || {main_tracks.get_artists(main_i)} VS {tracks.get_artists(i)}")
+
+        lines.append("")
+
+    return lines
+
 def get_old_tracks():
-    old_playlist = pd.read_csv('data/dj_kbot_trance.csv')
-    old_tracks = []
-    for _, row in old_playlist.iterrows():
-        title = sanitize_title(row['Track Name'])
-        artists = sanitize_artists(row['Artist Name(s)'].split(','))
-        old_tracks.append({
-            "title": title,
-            "artists": artists,
-            "og_title": row['Track Name'],
-            "og_artists": row['Artist Name(s)'].split(',')
-        })
-    
-    return old_tracks
+    # Yields the tracks of every export one chunk at a time
+    for old_playlist in read_export_chunks(["Track Name", "Artist Name(s)"]):
+        og_titles = old_playlist['Track Name'].tolist()
+        og_artists = old_playlist['Artist Name(s)'].str.split(',').tolist()
+        titles = sanitize_titles(old_playlist['Track Name'])
+        artists = sanitize_artist_lists(og_artists)
+
+        for title, track_artists, og_title, og_track_artists in zip(titles, artists, og_titles, og_artists):
+            yield {
+                "title": title,
+                "artists": track_artists,
+                "og_title": og_title,
+                "og_artists": og_track_artists
+            }
+
+def build_automaton(patterns):
+    # Aho-Corasick automaton, states are list indexes and state 0 is the root
+    goto = [{}]
+    fail = [0]
+    output = [[]]
+    for pattern_id, pattern in enumerate(patterns):
+        state = 0
+        for char in pattern:
+            if char not in goto[state]:
+                goto[state][char] = len(goto)
+                goto.append({})
+                fail.append(0)
+                output.append([])
+            state = goto[state][char]
+        output[state].append(pattern_id)
+
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for char, next_state in goto[state].items():
+            queue.append(next_state)
+
+            fail_state = fail[state]
+            while fail_state and char not in goto[fail_state]:
+                fail_state = fail[fail_state]
+            fail[next_state] = goto[fail_state].get(char, 0)
+            output[next_state] = output[next_state] + output[fail[next_state]]
+
+    return goto, fail, output
+
+def find_patterns(automaton, text):
+    goto, fail, output = automaton
+    pattern_ids = set()
+    state = 0
+    for char in text:
+        while state and char not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(char, 0)
+        pattern_ids.update(output[state])
+
+    return pattern_ids
 
 def get_missing_tracks(old_tracks):
-    missing_tracks = []
+    # Every playlist title is searched for in one pass over each old title, only tracks whose title hits get the artist check
+    title_artists = {}
+    for tracks in playlist_tracks.values():
+        for i, title in enumerate(tracks.titles):
+            title_artists.setdefault(title, []).append(tracks.get_artist_ids(i))
+
+    titles = [title for title in title_artists if title]
+    automaton = build_automaton(titles)
+
     for old_track in old_tracks:
-        is_track_found = False
-        for tracks in playlist_tracks.values():
-            for track in tracks:
-                if track['title'] in old_track['title'] and any(artist in old_track['artists'] for artist in track['artists']):
-                    is_track_found = True
-                    break
-
-            if is_track_found:
-                break
+        old_artist_ids = {artist_name_ids[artist] for artist in old_track['artists'] if artist in artist_name_ids}
+        candidate_titles = [titles[pattern_id] for pattern_id in find_patterns(automaton, old_track['title'])]
+        if '' in title_artists:
+            candidate_titles.append('')
+
+        is_track_found = any(
+            not old_artist_ids.isdisjoint(artist_ids)
+            for title in candidate_titles for artist_ids in title_artists[title]
+        )
         
         if not is_track_found:
-            missing_tracks.append(old_track)
-    
-    return missing_tracks
+            yield old_track
 
 def write_missing(missing_tracks):
-    lines = []
-    lines.append("intentionally_deleted_tracks = [")
+    yield "intentionally_deleted_tracks = ["
     for track in missing_tracks:
         track_str = f"{', '.join(track['og_artists'])} - {track['og_title']}"
         if track_str in intentionally_deleted_tracks:
             continue
         
-        lines.append(f"    \"{track_str}\",")
-    lines.append("]")
-    
-    return lines
+        yield f"    \"{track_str}\","
+    yield "]"
 
 def find_dupes():
     create_playlists()
@@ -233,6 +473,24 @@ def find_dupes():
             # print(line)
             f.write(f"{line}\n")
 
+def find_fuzzy_dupes():
+    create_playlists()
+
+    should_write_all_playlists = True # True False
+    main_playlist = "trance" # trance upbeat downbeat uplifting
+
+    lines = []
+    for playlist_name in playlists.keys():
+        if should_write_all_playlists or playlist_name == main_playlist:
+            matches = get_fuzzy_matches(playlist_name)
+            lines.extend(write_fuzzy_matches(playlist_name, matches))
+
+    os.makedirs("results", exist_ok=True)
+    with open(f"results/fuzzy_dupes.txt", "w") as f:
+        for line in lines:
+            # print(line)
+            f.write(f"{line}\n")
+
 def find_missing():
     create_playlists()
 
@@ -253,15 +511,16 @@ def find_not_album():
     not_album_tracks = {}
     for playlist_name, tracks in playlist_tracks.items():
         not_album_tracks[playlist_name] = []
-        for track in tracks:
-            if track['title'] not in track['album']:
-                not_album_tracks[playlist_name].append(track)
+        for i, (title, album) in enumerate(zip(tracks.titles, tracks.albums)):
+            if title not in album:
+                not_album_tracks[playlist_name].append(i)
     
     lines = []
-    for playlist_name, tracks in not_album_tracks.items():
+    for playlist_name, track_indexes in not_album_tracks.items():
         lines.append(f"\n{playlist_name}:")
-        for track in tracks:
-            lines.append(f"{track['title']} || {track['album']}")
+        tracks = playlist_tracks[playlist_name]
+        for i in track_indexes:
+            lines.append(f"{tracks.titles[i]} || {tracks.albums[i]}")
     
     os.makedirs("results", exist_ok=True)
     with open(f"results/not_album.txt", "w") as f:
@@ -269,7 +528,30 @@ def find_not_album():
             # print(line)
             f.write(f"{line}\n")
 
+REPORTS = {
+    "dupes": find_dupes,
+    "fuzzy_dupes": find_fuzzy_dupes,
+    "missing": find_missing,
+    "not_album": find_not_album,
+}
+
+def run_reports(report_names):
+    # Reports share one load of the playlists and run side by side
+    create_playlists()
+
+    with ThreadPoolExecutor(max_workers=len(report_names)) as executor:
+        futures = [executor.submit(REPORTS[report_name]) for report_name in report_names]
+
+    for future in futures:
+        future.result()
+
 if __name__ == "__main__":
-    find_dupes()
-    find_missing()
-    find_not_album()
+    parser = argparse.ArgumentParser(description="Write the given reports to results/, all of them when none are given")
+    parser.add_argument("reports", nargs="*", metavar="report", help=", ".join(REPORTS))
+    args = parser.parse_args()
+
+    for report_name in args.reports:
+        if report_name not in REPORTS:
+            parser.error(f"unknown report {report_name}, choose from {', '.join(REPORTS)}")
+
+    run_reports(list(dict.fromkeys(args.reports)) or list(REPORTS))
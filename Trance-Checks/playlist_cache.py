@@ -0,0 +1,140 @@
+import os
+import json
+import pickle
+import numpy as np
+
+CACHE_FOLDER = "cache/playlists"
+CACHE_VERSION = 1
+STRING_COLUMNS = ["id", "name", "album", "image_url", "added_at"]
+
+# Each playlist is a folder of .npy columns, strings are stored as one utf-8 blob plus offsets
+# and artists as codes into a table of unique artist names, everything is memory mapped on load
+
+def get_playlist_folder(playlist_name):
+    return f"{CACHE_FOLDER}/{playlist_name}"
+
+def load_array(path):
+    return np.load(path, mmap_mode='r')
+
+def save_strings(folder, column, strings):
+    blobs = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    np.cumsum([len(blob) for blob in blobs], out=offsets[1:])
+
+    np.save(f"{folder}/{column}.npy", np.frombuffer(b"".join(blobs), dtype=np.uint8))
+    np.save(f"{folder}/{column}_offsets.npy", offsets)
+
+def load_strings(folder, column):
+    data = load_array(f"{folder}/{column}.npy").tobytes()
+    offsets = load_array(f"{folder}/{column}_offsets.npy").tolist()
+
+    return [data[start:end].decode('utf-8') for start, end in zip(offsets, offsets[1:])]
+
+class Playlist:
+    def __init__(self, folder, meta):
+        self.folder = folder
+        self.meta = meta
+
+    def __len__(self):
+        return self.meta["track_count"]
+
+    def column(self, column):
+        return load_strings(self.folder, column)
+
+    def artists(self):
+        names = load_strings(self.folder, "artist_names")
+        codes = load_array(f"{self.folder}/artist_codes.npy").tolist()
+        offsets = load_array(f"{self.folder}/artist_offsets.npy").tolist()
+
+        return [[names[code] for code in codes[start:end]] for start, end in zip(offsets, offsets[1:])]
+
+    def rows(self):
+        # (values in STRING_COLUMNS order, artists) per track, the same shape item_to_row makes
+        columns = [self.column(column) for column in STRING_COLUMNS]
+        return list(zip(zip(*columns), self.artists()))
+
+    def tracks(self):
+        for values, artists in self.rows():
+            track = dict(zip(STRING_COLUMNS, values))
+            track["artists"] = artists
+            yield track
+
+def item_to_row(item):
+    track = item['track']
+    if not track:
+        # Removed or unavailable tracks come back empty
+        return
+
+    images = track['album']['images']
+    values = (
+        track['id'] or "",
+        track['name'],
+        track['album']['name'],
+        images[-1]['url'] if images else "",
+        item.get('added_at') or "",
+    )
+    artists = [artist['name'] for artist in track['artists']]
+
+    return values, artists
+
+def save_playlist(playlist_name, items, snapshot_id=None):
+    rows = [row for row in map(item_to_row, items) if row]
+    save_rows(playlist_name, rows, snapshot_id)
+
+def save_rows(playlist_name, rows, snapshot_id=None):
+    folder = get_playlist_folder(playlist_name)
+    os.makedirs(folder, exist_ok=True)
+
+    # Meta is written last so a half written playlist is never loaded
+    meta_path = f"{folder}/meta.json"
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    columns = list(zip(*[values for values, _ in rows])) or [()] * len(STRING_COLUMNS)
+    for column, strings in zip(STRING_COLUMNS, columns):
+        save_strings(folder, column, strings)
+
+    artist_lists = [artists for _, artists in rows]
+    artist_table = {}
+    codes = [artist_table.setdefault(artist, len(artist_table)) for artists in artist_lists for artist in artists]
+    offsets = np.zeros(len(artist_lists) + 1, dtype=np.int64)
+    np.cumsum([len(artists) for artists in artist_lists], out=offsets[1:])
+
+    save_strings(folder, "artist_names", list(artist_table))
+    np.save(f"{folder}/artist_codes.npy", np.array(codes, dtype=np.int32))
+    np.save(f"{folder}/artist_offsets.npy", offsets)
+
+    meta = {
+        "version": CACHE_VERSION,
+        "track_count": len(rows),
+        "snapshot_id": snapshot_id,
+    }
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+def migrate_pickle(playlist_name):
+    # Playlists cached before the columnar format as raw playlist_items pickles
+    pickle_path = f"cache/{playlist_name}.pkl"
+    if not os.path.exists(pickle_path):
+        return False
+
+    with open(pickle_path, "rb") as f:
+        items = pickle.load(f)
+    if not items:
+        return False
+
+    save_playlist(playlist_name, items)
+    return True
+
+def load_playlist(playlist_name):
+    folder = get_playlist_folder(playlist_name)
+    meta_path = f"{folder}/meta.json"
+    if not os.path.exists(meta_path) and not migrate_pickle(playlist_name):
+        return
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get("version") != CACHE_VERSION:
+        return
+
+    return Playlist(folder, meta)
@@ -0,0 +1,181 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import spotipy
+from spotipy.oauth2 import SpotifyClientCredentials
+from playlist_cache import load_playlist, save_playlist, save_rows, item_to_row
+
+PAGE_SIZE = 100
+# Only what's needed to tell which cached rows are still in the playlist and where
+KEY_FIELDS = "items(added_at,track(id)),total"
+
+FETCH_WORKERS = 8
+REQUESTS_PER_SECOND = 10
+REQUEST_BURST = 20
+MAX_RETRIES = 5
+
+page_executor = None
+
+# sp is anything with spotipy's playlist and playlist_items methods, so a local stand-in works too
+
+class TokenBucket:
+    # Shared by every fetch thread, a 429 pauses all of them until its Retry-After has passed
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+scheduler = TokenBucket(REQUESTS_PER_SECOND, REQUEST_BURST)
+
+def create_spotify():
+    # Client info is in environment variables
+    creds = SpotifyClientCredentials()
+
+    # A plain pooled session without spotipy's own retries, so 429s reach call_api
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=FETCH_WORKERS)
+    session.mount("https://", adapter)
+
+    return spotipy.Spotify(client_credentials_manager=creds, requests_session=session)
+
+def call_api(func, *args, **kwargs):
+    for attempt in range(MAX_RETRIES + 1):
+        scheduler.acquire()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            status = getattr(e, 'http_status', None) or 0
+            if attempt == MAX_RETRIES or (status != 429 and status < 500):
+                raise
+
+            if status == 429:
+                retry_after = (getattr(e, 'headers', None) or {}).get('Retry-After')
+                scheduler.pause(float(retry_after or 1))
+            else:
+                time.sleep(2 ** attempt)
+
+def get_page_executor():
+    global page_executor
+
+    if not page_executor:
+        page_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+
+    return page_executor
+
+def fetch_page(sp, playlist_id, offset, limit, fields):
+    return call_api(sp.playlist_items, playlist_id, fields=fields, limit=limit, offset=offset)['items']
+
+def get_range_pages(start, end):
+    return [(offset, min(PAGE_SIZE, end - offset)) for offset in range(start, end, PAGE_SIZE)]
+
+def fetch_pages(sp, playlist_id, pages, fields=None):
+    # (offset, limit) pages are requested concurrently, their items come back in the same order
+    offsets, limits = zip(*pages) if pages else ((), ())
+    results = get_page_executor().map(lambda offset, limit: fetch_page(sp, playlist_id, offset, limit, fields), offsets, limits)
+
+    return list(results)
+
+def fetch_items(sp, playlist_id, fields=None):
+    # The first page tells how many there are, the rest are fetched at once
+    results = call_api(sp.playlist_items, playlist_id, fields=fields, limit=PAGE_SIZE)
+    pages = fetch_pages(sp, playlist_id, get_range_pages(PAGE_SIZE, results['total']), fields)
+
+    return results['items'] + [item for page in pages for item in page]
+
+def get_item_key(item):
+    track = item['track']
+    if not track:
+        return
+
+    return track['id'] or "", item.get('added_at') or ""
+
+def get_changed_ranges(positions):
+    # Consecutive playlist positions grouped into [start, end) ranges
+    ranges = []
+    for position in positions:
+        if ranges and ranges[-1][1] == position:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([position, position + 1])
+
+    return ranges
+
+def merge_playlist(sp, playlist_id, playlist):
+    # Cached rows are reused wherever the same track added at the same time still is,
+    # only the positions that have no cached row are fetched in full
+    cached_rows = {}
+    for row in playlist.rows():
+        values, _ = row
+        cached_rows.setdefault((values[0], values[4]), []).append(row)
+
+    keys = [get_item_key(item) for item in fetch_items(sp, playlist_id, KEY_FIELDS)]
+
+    rows = [None] * len(keys)
+    changed_positions = []
+    for position, key in enumerate(keys):
+        if key is None:
+            continue
+
+        if cached_rows.get(key):
+            rows[position] = cached_rows[key].pop(0)
+        else:
+            changed_positions.append(position)
+
+    pages = [page for start, end in get_changed_ranges(changed_positions) for page in get_range_pages(start, end)]
+    for (offset, limit), items in zip(pages, fetch_pages(sp, playlist_id, pages)):
+        if len(items) != limit:
+            raise Exception("playlist changed while syncing")
+
+        for position, item in enumerate(items, offset):
+            if get_item_key(item) != keys[position]:
+                raise Exception("playlist changed while syncing")
+            rows[position] = item_to_row(item)
+
+    return [row for row in rows if row]
+
+def sync_playlist(sp, playlist_name, playlist_id, playlist=None):
+    # Returns the cached playlist as is when its snapshot_id is unchanged, else brings it up to date
+    playlist = playlist or load_playlist(playlist_name)
+
+    try:
+        snapshot_id = call_api(sp.playlist, playlist_id, fields="snapshot_id")['snapshot_id']
+        if playlist and playlist.meta["snapshot_id"] == snapshot_id:
+            return playlist
+
+        if playlist:
+            save_rows(playlist_name, merge_playlist(sp, playlist_id, playlist), snapshot_id)
+        else:
+            save_playlist(playlist_name, fetch_items(sp, playlist_id), snapshot_id)
+    except Exception as e:
+        print(f"Error accessing playlist: {str(e)}")
+        return playlist
+
+    return load_playlist(playlist_name)
+
+def sync_playlists(sp, playlist_ids):
+    # Every playlist is synced at once, their pages share the page executor and the scheduler
+    with ThreadPoolExecutor(max_workers=len(playlist_ids)) as executor:
+        futures = {name: executor.submit(sync_playlist, sp, name, playlist_id) for name, playlist_id in playlist_ids.items()}
+
+    return {name: future.result() for name, future in futures.items()}